@@ -0,0 +1,65 @@
+"""
+RESP parsing throughput: `PythonReader` vs `hiredis.Reader` (manual tool)
+
+kreps: kilo replies per second
+"""
+import time
+
+from redis.utils import HIREDIS_AVAILABLE
+if HIREDIS_AVAILABLE:
+    import hiredis
+
+from redis_batch.parser import PythonReader
+from examples import show_env_info
+
+
+NUM_REPLIES = 100000
+CHUNK_SIZE = 65536
+
+
+def _make_payloads():
+    bulk = b'$100\r\n' + b'x' * 100 + b'\r\n'
+    return [
+        ("status", b'+OK\r\n'),
+        ("integer", b':1234\r\n'),
+        ("bulk (100B)", bulk),
+        ("array (10 bulks)", b'*10\r\n' + bulk * 10),
+        ("nested array", b'*2\r\n*2\r\n:1\r\n:2\r\n*1\r\n$1\r\na\r\n'),
+    ]
+
+
+def parse(reader, data, n=NUM_REPLIES, chunk_size=CHUNK_SIZE):
+    """feed `data` in socket sized chunks, parse replies as they come"""
+    count = 0
+    for i in range(0, len(data), chunk_size):
+        reader.feed(data[i:i + chunk_size])
+        reply = reader.gets()
+        while reply is not False:
+            count += 1
+            reply = reader.gets()
+    assert count == n, count
+
+
+def _format_call_info(text, delta, n=NUM_REPLIES):
+    print("{:<40} {:.6f} sec ({:.2f} kreps) ".format(
+        text, delta, n / delta / 1000))
+
+
+def main():
+    show_env_info()
+    readers = [("PythonReader", PythonReader)]
+    if HIREDIS_AVAILABLE:
+        readers.append(("hiredis.Reader", hiredis.Reader))
+
+    for name, payload in _make_payloads():
+        print("\n---- {} ----\n".format(name))
+        data = payload * NUM_REPLIES
+        for reader_name, reader_class in readers:
+            t0 = time.time()
+            parse(reader_class(), data)
+            delta = time.time() - t0
+            _format_call_info(reader_name, delta)
+
+
+if __name__ == "__main__":
+    main()
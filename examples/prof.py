@@ -44,6 +44,19 @@ def async_gather_call(client, n=10):
     return out
 
 
+@asyncio.coroutine
+def async_task_gather_call(client, n=10):
+    """like async_gather_call but enqueue with one asyncio.Task per call"""
+    futures = []
+    for i in range(n):
+        fut = asyncio.Future(loop=client._loop)
+        asyncio.Task(client._pipe.pipeline_execute_command(fut, 'PING'),
+                     loop=client._loop)
+        futures.append(fut)
+    out = yield from asyncio.gather(*futures, loop=client._loop)
+    return out
+
+
 @asyncio.coroutine
 def asyncio_redis_call(client, loop, n=10):
     out = yield from asyncio.gather(
@@ -110,6 +123,11 @@ def main(event_loop):
         delta = time.time() - t0
         _format_call_info("Async Gather Batch Call", delta)
 
+        t0 = time.time()
+        yield from async_task_gather_call(async_pipeline_client, NUM_CALLS)
+        delta = time.time() - t0
+        _format_call_info("Async Gather Batch Call (Task put)", delta)
+
         # t0 = time.time()
         # yield from sync_async_mixin_call(dual_client, NUM_CALLS)
         # delta = time.time() - t0
@@ -1,10 +1,17 @@
 import redis
 import asyncio
+import functools
+from redis.client import list_or_args
 
 import redis_batch.pipeline
 import redis_batch.parser
 import redis_batch.connection
-from redis_batch.utils import PipeCommandQueue
+from redis_batch.packer import CommandPacker
+from redis_batch.stream import ReplyStream
+from redis_batch.columnar import column, scored_columns
+from redis_batch.utils import (
+    PipeCommandQueue, AdaptivePipeCommandQueue, IdlePipeCommandQueue,
+    PipeLaneQueue)
 
 __all__ = ['BatchRedisClient', 'BatchStrictRedisClient',
            'DualRedisClient', 'DualStrictRedisClient']
@@ -16,39 +23,190 @@ class BatchStrictRedisClient(redis.StrictRedis):
                  connection_pool=None, charset='utf-8',
                  errors='strict', decode_responses=False,
                  unix_socket_path=None,
+                 connection_class=None,
                  cmd_maxsize=500,
-                 cmd_timeout=0.01):
+                 cmd_timeout=0.01,
+                 cmd_adaptive=False,
+                 cmd_timeout_range=(0.0005, 0.05),
+                 cmd_maxsize_range=(10, 5000),
+                 cmd_mode=redis_batch.pipeline.MODE_TRANSACTION,
+                 cmd_max_inflight=None,
+                 cmd_multiplex=False,
+                 cmd_executor=None,
+                 cmd_offload_commands=(),
+                 cmd_offload_threshold=None,
+                 cmd_resolve_slice=None,
+                 cmd_max_loop_lag=0.005,
+                 cmd_retry_policy=None,
+                 cmd_call_timeout=None,
+                 cmd_lanes=None,
+                 cmd_lane_commands=None,
+                 cmd_flush_on_idle=False,
+                 cmd_max_connections=None,
+                 cmd_min_idle=0,
+                 cmd_idle_timeout=300):
+        """
+        `connection_class` defaults to `AsyncConnection` (or
+        `AsyncUnixDomainSocketConnection` with `unix_socket_path`), see
+        `AsyncProtocolConnection` for a transport feeding hiredis directly
+        (`AsyncUnixDomainSocketProtocolConnection` with `unix_socket_path`).
+
+        Commands are queued and executed in batches flushed every
+        `cmd_timeout` seconds or once `cmd_maxsize` commands are queued.
+        With `cmd_flush_on_idle` there is no window: commands queued during
+        a loop iteration are flushed as soon as it is over.
+
+        With `cmd_adaptive` both start at given values and then follow the
+        load within `cmd_timeout_range` and `cmd_maxsize_range`, see
+        `cmd_timeout` and `cmd_maxsize` properties for the current values.
+
+        `cmd_mode` selects how batches are executed:
+
+        - 'transaction': wrapped in MULTI/EXEC
+        - 'pipeline': plain pipelining without MULTI/EXEC
+        - 'auto': MULTI/EXEC only for batches holding a command queued with
+          `execute_command(..., atomic=True)` or by `execute_atomic`
+
+        The `atomic` option covers the whole batch its command lands in,
+        commands queued one by one may still land in different batches (cut
+        at `cmd_maxsize`, flushed by lanes), see `execute_atomic` to queue
+        commands executed in the same MULTI/EXEC.
+
+        The connection pool (unless `connection_pool` is given) opens up to
+        `cmd_max_connections`, closes the ones idle for `cmd_idle_timeout`
+        seconds but keeps `cmd_min_idle` open, see `warmup` to open them
+        up front.
+
+        `cmd_max_inflight` limits the number of batches executed at once,
+        each on its own connection. Commands are routed to connections by
+        key so commands on the same key are executed in order. Batches
+        executed as transactions are not split: one runs while no other
+        batch is in flight on the connections of its keys, so in the
+        'transaction' mode batches of many keys run one at a time (see the
+        'pipeline' and 'auto' modes).
+
+        With `cmd_multiplex` batches are sent over a connection back to back,
+        without waiting for the replies to the previous batch. Along with
+        `cmd_max_inflight` > 1 it requires the 'pipeline' mode.
+
+        Response callbacks of `cmd_offload_commands` (e.g. INFO, HGETALL)
+        and of replies longer than `cmd_offload_threshold` (bytes or
+        elements) run in `cmd_executor` (the loop default one if None).
+
+        With `cmd_resolve_slice` futures of a batch are resolved that many at
+        a time, yielding to the loop in between. Slices shrink while the loop
+        lags more than `cmd_max_loop_lag` seconds.
+
+        `cmd_retry_policy` (a `RetryPolicy`, by default one retry of the safe
+        commands) decides which batches failed with a `ConnectionError` are
+        retried, and how.
+
+        `cmd_call_timeout` is the default of the `timeout` option of
+        `execute_command`: seconds after which the future of a command fails
+        with `asyncio.TimeoutError` (None for no timeout). `socket_timeout`
+        limits connecting and reading the replies of a batch.
+
+        `cmd_lanes` adds command queue lanes with their own flush policy,
+        `{name: (timeout, maxsize)}`, next to the 'default' one (from
+        `cmd_timeout` and `cmd_maxsize`), e.g. `{'immediate': (0, 100)}`.
+        Commands go to the lane of their `lane` option, else the one of
+        their name in `cmd_lane_commands` (`{'GET': 'immediate'}`), see
+        `PipeLaneQueue`. Lanes are not adaptive.
+        """
         self._loop = loop
+        # a pool given by the caller may be shared, it is not closed here
+        self._own_pool = not connection_pool
         if not connection_pool:
+            self.packer = CommandPacker(charset, errors)
             kwargs = {
                 'loop': self._loop,
-                'host': host,
-                'port': port,
                 'db': db,
                 'password': password,
                 'socket_timeout': socket_timeout,
                 'encoding': charset,
                 'encoding_errors': errors,
                 'decode_responses': decode_responses,
-                'parser_class': redis_batch.parser.DefaultParser
+                'parser_class': redis_batch.parser.DefaultParser,
+                'packer': self.packer,
+                'max_connections': cmd_max_connections,
+                'min_idle': cmd_min_idle,
+                'idle_timeout': cmd_idle_timeout,
             }
-            connection_pool = redis.ConnectionPool(
-                connection_class=redis_batch.connection.AsyncConnection,
+            # based on input, setup appropriate connection args
+            if unix_socket_path is not None:
+                if connection_class is not None and not issubclass(
+                        connection_class, redis.UnixDomainSocketConnection):
+                    raise ValueError(
+                        '{} does not support unix_socket_path, see '
+                        'AsyncUnixDomainSocketProtocolConnection'.format(
+                            connection_class.__name__))
+                connection_class = connection_class or (
+                    redis_batch.connection.AsyncUnixDomainSocketConnection)
+                kwargs.update({
+                    'path': unix_socket_path,
+                    'connection_class': connection_class
+                })
+            else:
+                connection_class = connection_class or (
+                    redis_batch.connection.AsyncConnection)
+                kwargs.update({
+                    'host': host,
+                    'port': port,
+                    'connection_class': connection_class
+                })
+            connection_pool = redis_batch.connection.AsyncConnectionPool(
                 **kwargs)
+        else:
+            connection_kwargs = getattr(
+                connection_pool, 'connection_kwargs', {})
+            self.packer = connection_kwargs.get('packer') or CommandPacker(
+                connection_kwargs.get('encoding', charset),
+                connection_kwargs.get('encoding_errors', errors))
 
         self.connection_pool = connection_pool
+        self.call_timeout = cmd_call_timeout
         self.response_callbacks = self.RESPONSE_CALLBACKS
 
         # could be optionally external to client like the connection_pool
-        command_queue = PipeCommandQueue(
-            timeout=cmd_timeout, maxsize=cmd_maxsize, loop=self._loop)
+        if cmd_flush_on_idle:
+            if cmd_adaptive or cmd_lanes:
+                raise ValueError(
+                    'cmd_flush_on_idle excludes cmd_adaptive and cmd_lanes')
+            command_queue = IdlePipeCommandQueue(
+                maxsize=cmd_maxsize, loop=self._loop)
+        elif cmd_lanes:
+            if cmd_adaptive:
+                raise ValueError('cmd_lanes are not adaptive')
+            lanes = {'default': (cmd_timeout, cmd_maxsize)}
+            lanes.update(cmd_lanes)
+            command_queue = PipeLaneQueue(
+                lanes, 'default', cmd_lane_commands, loop=self._loop)
+        elif cmd_adaptive:
+            command_queue = AdaptivePipeCommandQueue(
+                timeout=cmd_timeout, maxsize=cmd_maxsize,
+                timeout_range=cmd_timeout_range,
+                maxsize_range=cmd_maxsize_range,
+                loop=self._loop)
+        else:
+            command_queue = PipeCommandQueue(
+                timeout=cmd_timeout, maxsize=cmd_maxsize, loop=self._loop)
+        self.command_queue = command_queue
         self._pipe = redis_batch.pipeline.AsyncStrictPipeline(
             command_queue,
             self.connection_pool,
             self.response_callbacks,
-            transaction=True,
+            transaction=cmd_mode == redis_batch.pipeline.MODE_TRANSACTION,
             shard_hint=None,
-            loop=self._loop)
+            loop=self._loop,
+            mode=cmd_mode,
+            max_inflight=cmd_max_inflight,
+            multiplex=cmd_multiplex,
+            executor=cmd_executor,
+            offload_commands=cmd_offload_commands,
+            offload_threshold=cmd_offload_threshold,
+            resolve_slice=cmd_resolve_slice,
+            max_loop_lag=cmd_max_loop_lag,
+            retry_policy=cmd_retry_policy)
 
     def __getattr__(self, name):
         """compatibility: forward self.async_XXX calls to self.XXX calls"""
@@ -61,13 +219,172 @@ class BatchStrictRedisClient(redis.StrictRedis):
     def get_event_loop(self):
         return self._loop
 
+    @property
+    def cmd_timeout(self):
+        """current batching window (seconds)"""
+        return self.command_queue.timeout
+
+    @property
+    def cmd_maxsize(self):
+        """current maximum batch size"""
+        return self.command_queue.maxsize
+
     def execute_command(self, *args, **options):
-        """put command on command stack"""
+        """
+        put command on command stack, its future fails with
+        `asyncio.TimeoutError` after `timeout` seconds (option)
+        """
         fut = asyncio.Future(loop=self._loop)
-        asyncio.Task(self._pipe.execute_command(
-            fut, *args, **options), loop=self._loop)
+        timeout = options.get('timeout', self.call_timeout)
+        if timeout is not None:
+            handle = self._loop.call_later(timeout, self._expire, fut)
+            fut.add_done_callback(lambda fut: handle.cancel())
+        self._pipe.push_command(fut, args, options)
         return fut
 
+    def _expire(self, *futures):
+        for fut in futures:
+            if not fut.done():
+                self._pipe.stats['timeouts'] += 1
+                fut.set_exception(asyncio.TimeoutError())
+
+    def execute_atomic(self, *commands, **options):
+        """
+        Queue `commands` (args tuples) as a group executed in one batch,
+        wrapped in MULTI/EXEC, returns a future of the list of replies:
+
+        >>> hits, ttl = yield from client.execute_atomic(
+        ...     ('INCR', 'hits'), ('EXPIRE', 'hits', 60))
+
+        Response callbacks get no options (e.g. no `withscores`). Options
+        (`timeout`, `lane`) apply to the whole group, which may make its
+        batch bigger than `cmd_maxsize`. Not supported in 'pipeline' mode.
+        """
+        if self._pipe.mode == redis_batch.pipeline.MODE_PIPELINE:
+            raise ValueError("execute_atomic needs cmd_mode 'transaction' "
+                             "or 'auto'")
+        futures = [asyncio.Future(loop=self._loop) for args in commands]
+        fut = asyncio.gather(*futures, loop=self._loop)
+        if not commands:
+            return fut
+        timeout = options.get('timeout', self.call_timeout)
+        if timeout is not None:
+            handle = self._loop.call_later(timeout, self._expire, *futures)
+            fut.add_done_callback(lambda fut: handle.cancel())
+        self._pipe.push_group(fut, list(zip(futures, commands)), options)
+        return fut
+
+    @asyncio.coroutine
+    def get_into(self, name, target=None, timeout=None):
+        """
+        GET the value of key `name` straight into `target` (bypassing the
+        batch, on a connection of its own), meant for large values:
+
+        - writable buffer (`bytearray`, `memoryview`, `mmap`, ...) returns a
+          `memoryview` of the value within `target`
+        - file (`write` method) returns the number of bytes written
+        - None returns the value as a `memoryview`
+
+        Returns None if the key does not exist. Raises `asyncio.TimeoutError`
+        after `timeout` (`cmd_call_timeout` by default) seconds.
+        """
+        if timeout is None:
+            timeout = self.call_timeout
+        connection = yield from self._pipe.acquire_connection()
+        try:
+            get = self._get_into(connection, name, target)
+            if timeout is None:
+                return (yield from get)
+            return (yield from asyncio.wait_for(
+                get, timeout, loop=self._loop))
+        except asyncio.TimeoutError:
+            connection.disconnect()  # the reply is left unread
+            raise
+        finally:
+            self.connection_pool.release(connection)
+
+    @asyncio.coroutine
+    def _get_into(self, connection, name, target):
+        if getattr(connection, 'needs_health_check', False):
+            connection.needs_health_check = False
+            yield from connection.send_packed_command(
+                connection.pack_command('PING'))
+            yield from self._pipe.read_health_check(connection)
+        yield from connection.send_packed_command(
+            connection.pack_command('GET', name))
+        return (yield from connection.read_bulk_into(target))
+
+    def stream(self, *args, chunk_size=1000, timeout=None):
+        """
+        Execute a command replying with a huge multi-bulk (`LRANGE`,
+        `SMEMBERS`, `HGETALL`, ...) on a connection of its own, returns
+        `ReplyStream` handing over raw elements as they get parsed:
+
+        >>> with client.stream('LRANGE', 'key', 0, -1) as stream:
+        ...     chunk = yield from stream.next_chunk()  # [] once done
+        >>> async with client.stream('SMEMBERS', 'key') as stream:
+        ...     async for element in stream:
+        ...         break  # the connection is released on exit
+
+        Each chunk has to be read within `timeout` (`cmd_call_timeout` by
+        default) seconds, see `ReplyStream`.
+        """
+        if timeout is None:
+            timeout = self.call_timeout
+        return ReplyStream(self._pipe, args, chunk_size, timeout)
+
+    def zrange_columns(self, name, start, end, desc=False, use_numpy=None):
+        """
+        ZRANGE ... WITHSCORES as (members, float64 scores array), see
+        `redis_batch.columnar`
+        """
+        return self.execute_command(
+            'ZREVRANGE' if desc else 'ZRANGE', name, start, end, 'WITHSCORES',
+            columnar=functools.partial(scored_columns, use_numpy=use_numpy))
+
+    def mget_column(self, keys, *args, dtype='int64', missing=0,
+                    use_numpy=None):
+        """
+        MGET of numeric values as one `dtype` (int64 or float64) array,
+        missing keys get `missing` value, see `redis_batch.columnar`
+        """
+        args = list_or_args(keys, args)
+        return self.execute_command('MGET', *args, columnar=functools.partial(
+            column, dtype=dtype, missing=missing, use_numpy=use_numpy))
+
+    def prepare(self, *args):
+        """
+        Command with fixed leading `args` packed once, returns a function
+        queueing it with the remaining args:
+
+        >>> hget_users = client.prepare('HGET', 'users')
+        >>> resp = yield from hget_users('user_id')
+        """
+        prepared = self.packer.prepare(*args)
+
+        def execute(*vargs, **options):
+            return self.execute_command(
+                *(args + vargs), packed=prepared.pack(*vargs), **options)
+        return execute
+
+    @asyncio.coroutine
+    def warmup(self):
+        """Open the `cmd_min_idle` connections of the pool up front"""
+        warmup = getattr(self.connection_pool, 'warmup', None)
+        if warmup is not None:
+            yield from warmup()
+
+    def close(self):
+        """
+        Give the connections pinned by `cmd_max_inflight` slots back to the
+        pool (once their batches in flight are done), then disconnect the
+        pool unless it was given to the client. Meant for when no more
+        commands are queued.
+        """
+        self._pipe.release_slots()
+        if self._own_pool:
+            self.connection_pool.disconnect()
+
 
 class BatchRedisClient(redis.Redis, BatchStrictRedisClient):
     pass
@@ -93,7 +410,9 @@ def _dual_client_factory(client_class, async_client_class):
             self._async_client = async_client_class(
                 loop, **async_clinet_kwargs)
 
-            # redis-py
+            # redis-py (cmd_XXX kwargs are batching only)
+            kwargs = {k: v for k, v in kwargs.items()
+                      if not k.startswith('cmd_') and k != 'connection_class'}
             super(ClientClass, self).__init__(**kwargs)
 
         def __getattr__(self, name):
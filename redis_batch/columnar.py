@@ -0,0 +1,57 @@
+"""
+Columnar results: replies of numeric values (MGET of counters, scores of
+ZRANGE ... WITHSCORES) built in bulk into one compact array instead of a
+Python object per element.
+
+NumPy arrays are returned when NumPy is installed, `array.array` otherwise
+(or with `use_numpy=False`).
+"""
+import array
+
+from redis.exceptions import RedisError
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    numpy = None
+    NUMPY_AVAILABLE = False
+
+__all__ = ['column', 'scored_columns', 'NUMPY_AVAILABLE']
+
+# dtype -> (array.array typecode, python type)
+DTYPES = {
+    'int64': ('q', int),
+    'float64': ('d', float),
+}
+
+
+def column(values, dtype='float64', missing=0, use_numpy=None):
+    """
+    Array of `dtype` (int64 or float64) from raw reply `values`, nil values
+    are replaced with `missing`. `use_numpy=True` requires NumPy.
+    """
+    if use_numpy and not NUMPY_AVAILABLE:
+        raise RedisError("NumPy is not installed")
+    typecode, type_ = DTYPES[dtype]
+    if None in values:
+        # same type as the values, so they are all parsed alike
+        fill = repr(missing)
+        if any(isinstance(v, bytes) for v in values):
+            fill = fill.encode()
+        values = [fill if v is None else v for v in values]
+    if use_numpy is None:
+        use_numpy = NUMPY_AVAILABLE
+    if use_numpy:
+        if not values:
+            return numpy.empty(0, dtype=dtype)
+        # parsed from the bytes in bulk, not one python object per value
+        return numpy.array(values).astype(dtype)
+    return array.array(typecode, map(type_, values))
+
+
+def scored_columns(reply, use_numpy=None):
+    """
+    Raw `ZRANGE ... WITHSCORES` reply into (members, float64 scores)
+    """
+    return reply[0::2], column(reply[1::2], 'float64', use_numpy=use_numpy)
@@ -1,10 +1,18 @@
 import sys
 import asyncio
+import collections
 
-from redis.connection import Connection
+from redis.connection import (
+    BaseParser,
+    Connection,
+    UnixDomainSocketConnection,
+    SYM_EMPTY,
+)
+from redis._compat import nativestr
 from redis.exceptions import (
     RedisError,
     ConnectionError,
+    DataError,
     BusyLoadingError,
     ResponseError,
     InvalidResponse,
@@ -12,19 +20,93 @@ from redis.exceptions import (
     NoScriptError,
     ExecAbortError,
 )
+from redis.utils import HIREDIS_AVAILABLE
+if HIREDIS_AVAILABLE:
+    import hiredis
+
+from redis_batch.parser import PythonReader
+from redis_batch.packer import CommandPacker, BUFFER_CUTOFF
+
+__all__ = ['AsyncConnection', 'AsyncUnixDomainSocketConnection',
+           'AsyncProtocolConnection',
+           'AsyncUnixDomainSocketProtocolConnection',
+           'AsyncConnectionPool', 'ReplyTurn', 'ConnectError']
+
+
+# bulk values are read from the socket in pieces up to this size
+MAX_READ_LENGTH = 1000000
+
+
+class ConnectError(ConnectionError):
+    """Connecting failed, nothing got sent"""
+
+
+class ReplyTurn:
+    """
+    Place of a sent batch in the line of batches waiting for replies on a
+    connection. Replies are read in the order batches were sent so the
+    reading is done within the turn:
+
+    >>> turn = yield from connection.send_packed_batch(packed)
+    >>> with turn:
+    ...     yield from turn.wait()
+    ...     # read the batch replies
+    ...     turn.release()
 
-__all__ = ['AsyncConnection']
+    Leaving the block with an error before `release` disconnects, as the
+    replies left unread would be read by the next batches. Unless the
+    connection got disconnected since the batch was sent: its socket is
+    gone already and the current one belongs to newer batches.
+    """
+    def __init__(self, connection, previous=None):
+        self.connection = connection
+        self.generation = connection.generation
+        self.previous = previous
+        self.future = asyncio.Future(loop=connection.get_event_loop())
+
+    @asyncio.coroutine
+    def wait(self):
+        """Wait until replies of the previously sent batches are read"""
+        if self.previous is not None and not self.previous.done():
+            yield from asyncio.shield(
+                self.previous, loop=self.connection.get_event_loop())
+        if self.generation != self.connection.generation:
+            raise ConnectionError("Connection lost before reading replies")
+
+    def release(self):
+        """Let the next batch read its replies"""
+        if not self.future.done():
+            self.future.set_result(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is not None and not self.future.done() and
+                self.generation == self.connection.generation):
+            self.connection.disconnect()
+        self.release()
 
 
 class AsyncConnection(Connection):
     def __init__(
             self,
             loop=None,
+            packer=None,
             **kwargs):
         super().__init__(**kwargs)
         self._loop = loop
+        # may be shared by the connections of a pool
+        self.packer = packer or CommandPacker(
+            self.encoding, self.encoding_errors)
         self._reader = None
         self._writer = None
+        self._write_lock = asyncio.Lock(loop=loop)
+        self._last_turn = None
+        # bumped on disconnect, invalidates pending `ReplyTurn`s
+        self.generation = 0
+        # set by `AsyncConnectionPool` for connections idle for a while
+        self.needs_health_check = False
 
     def get_event_loop(self):
         return self._loop
@@ -42,6 +124,8 @@ class AsyncConnection(Connection):
             self._writer.close()
         self._reader = None
         self._writer = None
+        self._last_turn = None
+        self.generation += 1
 
     @asyncio.coroutine
     def connect(self):
@@ -49,26 +133,68 @@ class AsyncConnection(Connection):
         if self._writer:
             return
         try:
-            self._reader, self._writer = yield from asyncio.open_connection(
-                self.host, self.port, loop=self._loop)
+            self._reader, self._writer = yield from self.with_timeout(
+                self._open_connection())
+        except asyncio.TimeoutError:
+            raise ConnectError("Timeout connecting to server")
         except Exception:
             e = sys.exc_info()[1]
-            raise ConnectionError(self._error_message(e))
+            raise ConnectError(self._error_message(e))
 
         try:
-            self.on_connect()
+            yield from self.on_connect()
         except RedisError:
             # clean up after any error in on_connect
             self.disconnect()
             raise
 
+    @asyncio.coroutine
+    def on_connect(self):
+        "Initialize the connection, authenticate and select a database"
+        self._parser.on_connect(self)
+        yield from self.init_session()
+
+    @asyncio.coroutine
+    def init_session(self):
+        "Authenticate and select the database, if set"
+        if self.password:
+            yield from self.send_packed_command(
+                self.pack_command('AUTH', self.password))
+            if nativestr((yield from self.read_response())) != 'OK':
+                raise AuthenticationError('Invalid Password')
+
+        if self.db:
+            yield from self.send_packed_command(
+                self.pack_command('SELECT', self.db))
+            if nativestr((yield from self.read_response())) != 'OK':
+                raise ConnectionError('Invalid Database')
+
+    def with_timeout(self, coro):
+        "`coro` limited to `socket_timeout` seconds, if set"
+        if self.socket_timeout is None:
+            return coro
+        return asyncio.wait_for(coro, self.socket_timeout, loop=self._loop)
+
+    @asyncio.coroutine
+    def _open_connection(self):
+        "Create a TCP connection, returns (reader, writer) streams"
+        return (yield from asyncio.open_connection(
+            self.host, self.port, loop=self._loop))
+
     @asyncio.coroutine
     def send_packed_command(self, command):
-        "Send an already packed command to the Redis server"
+        """
+        Send an already packed command (or list of chunks, see
+        `pack_commands`) to the Redis server
+        """
         if not self._writer:
             yield from self.connect()
+        if isinstance(command, bytes):
+            command = [command]
         try:
-            self._writer.write(command)
+            # chunk by chunk: writelines would join them into one buffer
+            for chunk in command:
+                self._writer.write(chunk)
             yield from self._writer.drain()
         except Exception:
             e = sys.exc_info()[1]
@@ -83,11 +209,75 @@ class AsyncConnection(Connection):
             self.disconnect()
             raise
 
+    def pack_command(self, *args):
+        "Pack a series of arguments into a list of chunks"
+        return self.packer.pack_command(*args)
+
+    def pack_commands(self, commands):
+        """
+        Pack multiple commands into a list of chunks to write. Small pieces
+        are joined up to `BUFFER_CUTOFF`, large values (`pack_command`
+        returning a list of chunks) are never copied into a bigger buffer.
+
+        `commands` are args tuples or already packed commands (see
+        `PreparedCommand`).
+        """
+        output = []
+        pieces = []
+        buffer_length = 0
+        for args in commands:
+            if isinstance(args, tuple):
+                packed = self.pack_command(*args)
+            else:
+                packed = args
+            if isinstance(packed, bytes):
+                packed = [packed]
+            for chunk in packed:
+                if len(chunk) > BUFFER_CUTOFF:
+                    if pieces:
+                        output.append(SYM_EMPTY.join(pieces))
+                        pieces = []
+                        buffer_length = 0
+                    output.append(chunk)
+                    continue
+                pieces.append(chunk)
+                buffer_length += len(chunk)
+                if buffer_length > BUFFER_CUTOFF:
+                    output.append(SYM_EMPTY.join(pieces))
+                    pieces = []
+                    buffer_length = 0
+        if pieces:
+            output.append(SYM_EMPTY.join(pieces))
+        return output
+
+    @asyncio.coroutine
+    def send_packed_batch(self, command):
+        """
+        Send an already packed batch of commands, returns its `ReplyTurn`.
+
+        The next batch can be sent before replies to this one got read so
+        several batches stream over the connection back to back.
+        """
+        with (yield from self._write_lock):
+            yield from self.connect()
+            turn = ReplyTurn(self, self._last_turn)
+            self._last_turn = turn.future
+            try:
+                yield from self.send_packed_command(command)
+            except:
+                turn.release()
+                raise
+            return turn
+
     @asyncio.coroutine
     def read_response(self):
         "Read the response from a previously sent command"
         try:
-            response = yield from self._parser.read_response()
+            response = yield from self.with_timeout(
+                self._parser.read_response())
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise ConnectionError("Timeout reading from socket")
         except:
             self.disconnect()
             raise
@@ -95,4 +285,509 @@ class AsyncConnection(Connection):
             raise response
         return response
 
+    @asyncio.coroutine
+    def read_responses(self, n, on_reply=None):
+        """
+        Read `n` responses, error replies are returned (not raised).
+        `on_reply(i, response)` is called as soon as each one is read.
+        All of them have to arrive within `socket_timeout` seconds.
+        """
+        if hasattr(self._parser, 'read_responses'):
+            read = self._parser.read_responses(n, on_reply)
+        else:
+            read = self._read_responses(n, on_reply)
+        try:
+            return (yield from self.with_timeout(read))
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise ConnectionError("Timeout reading from socket")
+        except:
+            self.disconnect()
+            raise
+
+    @asyncio.coroutine
+    def _read_responses(self, n, on_reply=None):
+        "`read_responses` one `read_response` at a time"
+        responses = []
+        for i in range(n):
+            response = yield from self._parser.read_response()
+            if on_reply is not None:
+                on_reply(i, response)
+            responses.append(response)
+        return responses
+
+    @asyncio.coroutine
+    def read_bulk_into(self, target=None):
+        """
+        Read a bulk reply straight from the socket into `target`, the value
+        is not buffered by the parser:
+
+        - writable buffer (`bytearray`, `memoryview`, `mmap`, ...) returns a
+          `memoryview` of the value within `target`
+        - file (`write` method) returns the number of bytes written
+        - None returns a `memoryview` of a new `bytearray`
+
+        Returns None for a nil reply, only to be used with no replies pending
+        on the connection. The reply has to arrive within `socket_timeout`
+        seconds.
+        """
+        try:
+            return (yield from self.with_timeout(
+                self._read_bulk_reply(target)))
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise ConnectionError("Timeout reading from socket")
+
+    @asyncio.coroutine
+    def _read_bulk_reply(self, target):
+        try:
+            line = yield from self._reader.readline()
+            if not line:
+                raise ConnectionError("Socket closed on remote end")
+            byte, line = line[:1], line[1:-2]
+            if byte == b'-':
+                error = self._parser.parse_error(nativestr(line))
+            elif byte != b'$':
+                raise InvalidResponse("Protocol Error: %r" % (byte + line))
+            else:
+                error = None
+                length = int(line)
+                if length == -1:
+                    return None
+                value = yield from self._read_bulk(target, length)
+                yield from self._reader.readexactly(2)  # CRLF
+                return value
+        except (asyncio.CancelledError, ConnectionError, DataError,
+                InvalidResponse):
+            self.disconnect()
+            raise
+        except Exception:
+            e = sys.exc_info()[1]
+            self.disconnect()
+            raise ConnectionError("Error while reading from socket: %s" %
+                                  (e.args,))
+        raise error
+
+    @asyncio.coroutine
+    def _read_bulk(self, target, length):
+        if target is None:
+            target = bytearray(length)
+        try:
+            view = memoryview(target)
+        except TypeError:
+            view = None
+        else:
+            if length > view.nbytes:
+                raise DataError("Value of %d bytes does not fit %d bytes "
+                                "target" % (length, view.nbytes))
+        offset = 0
+        while offset < length:
+            chunk = yield from self._reader.read(
+                min(length - offset, MAX_READ_LENGTH))
+            if not chunk:
+                raise ConnectionError("Socket closed on remote end")
+            if view is None:
+                target.write(chunk)
+            else:
+                view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        if view is None:
+            return length
+        return view[:length]
+
     # def _error_message(self, exception): TODO
+
+
+class AsyncUnixDomainSocketConnection(AsyncConnection,
+                                      UnixDomainSocketConnection):
+    @asyncio.coroutine
+    def _open_connection(self):
+        "Create a Unix domain socket connection"
+        return (yield from asyncio.open_unix_connection(
+            self.path, loop=self._loop))
+
+
+class BatchReplies:
+    """`n` replies of a batch, `on_reply(i, reply)` called on each one"""
+    def __init__(self, n, on_reply=None, loop=None):
+        self.n = n
+        self.on_reply = on_reply
+        self.replies = []
+        self.future = asyncio.Future(loop=loop)
+
+    def feed(self, reply):
+        """:returns: True once all the `n` replies were fed"""
+        if self.on_reply is not None:
+            self.on_reply(len(self.replies), reply)
+        self.replies.append(reply)
+        if len(self.replies) < self.n:
+            return False
+        if not self.future.done():
+            self.future.set_result(self.replies)
+        return True
+
+    def fail(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class RedisProtocol(asyncio.Protocol):
+    """
+    Feeds received data straight into a `hiredis.Reader` (or `PythonReader`)
+    and hands every complete reply to the `BatchReplies` waiting for it, or
+    keeps it until one does. Replies are parsed in `data_received` so a batch
+    costs one coroutine wakeup, not one per reply.
+    """
+    def __init__(self, reader, loop=None):
+        self._reader = reader
+        self._loop = loop
+        self._error_parser = BaseParser()
+        self._replies = collections.deque()  # not waited for yet
+        self._batch = None
+        self._paused = False
+        self._drain_waiter = None
+        self.transport = None
+        self.exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.exception is not None:
+            return
+        self._reader.feed(data)
+        while True:
+            try:
+                reply = self._reader.gets()
+            except Exception:
+                self._fail(sys.exc_info()[1])
+                return
+            if reply is False:
+                break
+            if isinstance(reply, ResponseError):
+                reply = self._error_parser.parse_error(reply.args[0])
+                if isinstance(reply, ConnectionError):
+                    self._fail(reply)
+                    return
+            if self._batch is None:
+                self._replies.append(reply)
+                continue
+            try:
+                if self._batch.feed(reply):
+                    self._batch = None
+            except Exception:  # on_reply error
+                self._fail(sys.exc_info()[1])
+                return
+
+    def connection_lost(self, exc):
+        self._fail(ConnectionError("Socket closed on remote end"))
+        if self._paused:
+            self.resume_writing()
+
+    def _fail(self, exc):
+        if self.exception is None:
+            self.exception = exc
+        if self._batch is not None:
+            self._batch.fail(exc)
+            self._batch = None
+        if self.transport is not None:
+            self.transport.close()
+
+    @asyncio.coroutine
+    def read_replies(self, n, on_reply=None):
+        """Wait for the next `n` replies"""
+        batch = BatchReplies(n, on_reply, loop=self._loop)
+        while self._replies:
+            if batch.feed(self._replies.popleft()):
+                return batch.replies
+        if self.exception is not None:
+            raise self.exception
+        self._batch = batch
+        return (yield from batch.future)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    @asyncio.coroutine
+    def drain(self):
+        if self.exception is not None:
+            raise self.exception
+        if not self._paused:
+            return
+        self._drain_waiter = asyncio.Future(loop=self._loop)
+        yield from self._drain_waiter
+
+
+class AsyncProtocolConnection(AsyncConnection):
+    """
+    AsyncConnection on top of `RedisProtocol` (no StreamReader/Writer),
+    parses with hiredis when installed, `PythonReader` otherwise
+    """
+    def __init__(self, loop=None, **kwargs):
+        super().__init__(loop=loop, **kwargs)
+        self._transport = None
+        self._protocol = None
+
+    def make_reader(self):
+        kwargs = {
+            'protocolError': InvalidResponse,
+            'replyError': ResponseError,
+        }
+        if self.decode_responses:
+            kwargs['encoding'] = self.encoding
+        if HIREDIS_AVAILABLE:
+            return hiredis.Reader(**kwargs)
+        return PythonReader(**kwargs)
+
+    def disconnect(self):
+        "Disconnects from the Redis server"
+        if self._protocol is not None:
+            self._protocol._fail(ConnectionError("Connection closed"))
+        self._transport = None
+        self._protocol = None
+        self._last_turn = None
+        self.generation += 1
+
+    @asyncio.coroutine
+    def _create_connection(self, protocol_factory):
+        return (yield from self._loop.create_connection(
+            protocol_factory, self.host, self.port))
+
+    @asyncio.coroutine
+    def connect(self):
+        "Connects to the Redis server if not already connected"
+        if self._transport:
+            return
+        reader = self.make_reader()
+        try:
+            self._transport, self._protocol = yield from self.with_timeout(
+                self._create_connection(
+                    lambda: RedisProtocol(reader, loop=self._loop)))
+        except asyncio.TimeoutError:
+            raise ConnectError("Timeout connecting to server")
+        except Exception:
+            e = sys.exc_info()[1]
+            raise ConnectError(self._error_message(e))
+
+        try:
+            # no parser to set up, replies are parsed by the protocol
+            yield from self.init_session()
+        except RedisError:
+            self.disconnect()
+            raise
+
+    @asyncio.coroutine
+    def send_packed_command(self, command):
+        "Send an already packed command to the Redis server"
+        if not self._transport:
+            yield from self.connect()
+        if isinstance(command, bytes):
+            command = [command]
+        try:
+            for chunk in command:
+                self._transport.write(chunk)
+            yield from self._protocol.drain()
+        except ConnectionError:
+            self.disconnect()
+            raise
+        except Exception:
+            e = sys.exc_info()[1]
+            self.disconnect()
+            raise ConnectionError("Error while writing to socket. %s." %
+                                  (e.args,))
+
+    @asyncio.coroutine
+    def read_responses(self, n, on_reply=None):
+        if self._protocol is None:
+            raise ConnectionError("Socket closed on remote end")
+        try:
+            return (yield from self.with_timeout(
+                self._protocol.read_replies(n, on_reply)))
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise ConnectionError("Timeout reading from socket")
+        except ConnectionError:
+            self.disconnect()
+            raise
+
+    @asyncio.coroutine
+    def read_bulk_into(self, target=None):
+        """
+        Like `AsyncConnection.read_bulk_into` but the value gets parsed
+        first, so it is copied into `target` once more
+        """
+        value = yield from self.read_response()
+        if value is None:
+            return None
+        if isinstance(value, str):  # decode_responses
+            value = value.encode(self.encoding, self.encoding_errors)
+        if target is None:
+            return memoryview(value)
+        try:
+            view = memoryview(target)
+        except TypeError:
+            target.write(value)
+            return len(value)
+        if len(value) > view.nbytes:
+            raise DataError("Value of %d bytes does not fit %d bytes "
+                            "target" % (len(value), view.nbytes))
+        view[:len(value)] = value
+        return view[:len(value)]
+
+    @asyncio.coroutine
+    def read_response(self):
+        "Read the response from a previously sent command"
+        response = (yield from self.read_responses(1))[0]
+        if isinstance(response, ResponseError):
+            raise response
+        return response
+
+
+class AsyncUnixDomainSocketProtocolConnection(AsyncProtocolConnection,
+                                              UnixDomainSocketConnection):
+    @asyncio.coroutine
+    def _create_connection(self, protocol_factory):
+        return (yield from self._loop.create_unix_connection(
+            protocol_factory, self.path))
+
+
+class AsyncConnectionPool:
+    """
+    asyncio native connection pool:
+
+    - `acquire` waits (up to `timeout`) while `max_connections` are in use
+    - `warmup` opens `min_idle` connections up front
+    - connections idle for `idle_timeout` are closed, keeping `min_idle`
+    - connections idle for `health_check_interval` are acquired with
+      `needs_health_check` set, a PING is then sent along with their next
+      batch
+    """
+    def __init__(self, connection_class=AsyncConnection, max_connections=None,
+                 min_idle=0, idle_timeout=300, health_check_interval=30,
+                 timeout=None, loop=None, **connection_kwargs):
+        self.connection_class = connection_class
+        self.connection_kwargs = connection_kwargs
+        self.connection_kwargs['loop'] = loop
+        self.max_connections = max_connections or 2 ** 31
+        self.min_idle = min_idle
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._loop = loop
+        self._created_connections = 0
+        self._idle = collections.deque()  # (connection, idle since), LIFO
+        self._in_use = set()
+        self._waiters = collections.deque()
+        self._reaper = None
+
+    def __repr__(self):
+        return "%s<%s>" % (
+            type(self).__name__,
+            self.connection_class.description_format % self.connection_kwargs,
+        )
+
+    def make_connection(self):
+        "Create a new connection"
+        if self._created_connections >= self.max_connections:
+            raise ConnectionError("Too many connections")
+        self._created_connections += 1
+        return self.connection_class(**self.connection_kwargs)
+
+    def _take_idle(self):
+        connection, idle_since = self._idle.pop()
+        idle = self._loop.time() - idle_since
+        connection.needs_health_check = (
+            self.health_check_interval is not None and
+            idle >= self.health_check_interval)
+        self._in_use.add(connection)
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        "Get a connection from the pool, never waits"
+        if self._idle:
+            return self._take_idle()
+        connection = self.make_connection()
+        self._in_use.add(connection)
+        return connection
+
+    @asyncio.coroutine
+    def acquire(self, timeout=None):
+        """
+        Get a connection from the pool, waits up to `timeout` (or the pool
+        `timeout`) for one to be released if `max_connections` are in use.
+        """
+        if self._idle:
+            return self._take_idle()
+        if self._created_connections < self.max_connections:
+            connection = self.make_connection()
+            self._in_use.add(connection)
+            return connection
+
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            return (yield from asyncio.wait_for(
+                waiter, timeout or self.timeout, loop=self._loop))
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return waiter.result()  # released just in time
+            raise ConnectionError("No connection available.")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # handed over to a caller cancelled meanwhile
+                self.release(waiter.result())
+            raise
+
+    def release(self, connection):
+        "Releases the connection back to the pool"
+        self._in_use.discard(connection)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                connection.needs_health_check = False
+                self._in_use.add(connection)
+                waiter.set_result(connection)
+                return
+        self._idle.append((connection, self._loop.time()))
+        if self._reaper is None and self.idle_timeout is not None:
+            self._reaper = self._loop.call_later(
+                self.idle_timeout, self._reap)
+
+    def _reap(self):
+        "Close connections idle for `idle_timeout`, keeping `min_idle`"
+        self._reaper = None
+        now = self._loop.time()
+        while len(self._idle) > self.min_idle:
+            connection, idle_since = self._idle[0]
+            if idle_since + self.idle_timeout > now:
+                self._reaper = self._loop.call_at(
+                    idle_since + self.idle_timeout, self._reap)
+                break
+            self._idle.popleft()
+            connection.disconnect()
+            self._created_connections -= 1
+
+    @asyncio.coroutine
+    def warmup(self):
+        "Open connections until `min_idle` are idle"
+        while len(self._idle) < self.min_idle:
+            connection = self.make_connection()
+            try:
+                yield from connection.connect()
+            except ConnectionError:
+                self._created_connections -= 1
+                raise
+            self._idle.append((connection, self._loop.time()))
+
+    def disconnect(self):
+        "Disconnects all connections in the pool"
+        for connection, idle_since in self._idle:
+            connection.disconnect()
+        for connection in self._in_use:
+            connection.disconnect()
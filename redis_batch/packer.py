@@ -0,0 +1,136 @@
+"""
+RESP packing for the batch path:
+
+- `CommandPacker` caches the `*N\\r\\n$len\\r\\nNAME\\r\\n` headers per
+  command name and arity, and keeps a bounded LRU of encoded keys
+- `PreparedCommand` packs its fixed leading arguments once, only the
+  variable ones are encoded per call
+"""
+import collections
+
+from redis._compat import b, basestring, unicode
+from redis.connection import (
+    SYM_STAR,
+    SYM_DOLLAR,
+    SYM_CRLF,
+    SYM_EMPTY,
+)
+
+__all__ = ['CommandPacker', 'PreparedCommand']
+
+# packed pieces up to this size are joined before writing, bigger ones
+# (large values) are written as they are
+BUFFER_CUTOFF = 6000
+
+
+class CommandPacker:
+    def __init__(self, encoding='utf-8', encoding_errors='strict',
+                 max_cached_keys=10000, max_cached_key_size=256):
+        self.encoding = encoding
+        self.encoding_errors = encoding_errors
+        self.max_cached_keys = max_cached_keys
+        self.max_cached_key_size = max_cached_key_size
+        self._headers = {}  # (name, arity) -> packed header and name
+        self._keys = collections.OrderedDict()  # key -> packed key
+
+    def encode(self, value):
+        "Return a bytestring representation of the value"
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, float):
+            value = repr(value)
+        if not isinstance(value, basestring):
+            value = str(value)
+        if isinstance(value, unicode):
+            value = value.encode(self.encoding, self.encoding_errors)
+        return value
+
+    def pack_arg(self, value, output):
+        "Append the packed `value` to `output` chunks"
+        value = self.encode(value)
+        header = SYM_EMPTY.join((SYM_DOLLAR, b(str(len(value))), SYM_CRLF))
+        if len(value) > BUFFER_CUTOFF:
+            # keep large values apart, they are written without a copy
+            output.extend((header, value, SYM_CRLF))
+        else:
+            output.append(SYM_EMPTY.join((header, value, SYM_CRLF)))
+
+    def pack_key(self, key, output):
+        "`pack_arg` with the packed (str or bytes) keys LRU cached"
+        if type(key) not in (str, bytes):
+            return self.pack_arg(key, output)
+        try:
+            packed = self._keys[key]
+        except KeyError:
+            pieces = []
+            self.pack_arg(key, pieces)
+            packed = SYM_EMPTY.join(pieces)
+            if len(packed) <= self.max_cached_key_size:
+                self._keys[key] = packed
+                if len(self._keys) > self.max_cached_keys:
+                    self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+        output.append(packed)
+
+    def pack_header(self, name, arity):
+        """
+        Packed `*arity` header followed by the packed command `name`. Like
+        redis-py 2.10 a name of several words ('CONFIG GET') is sent as that
+        many arguments, the extra ones are added to `arity`.
+        """
+        try:
+            return self._headers[name, arity]
+        except KeyError:
+            words = self.encode(name).split(b' ')
+            pieces = [SYM_STAR, b(str(arity + len(words) - 1)), SYM_CRLF]
+            for word in words:
+                self.pack_arg(word, pieces)
+            header = self._headers[name, arity] = SYM_EMPTY.join(pieces)
+            return header
+
+    def pack_command(self, *args):
+        "Pack a series of arguments into a list of chunks"
+        output = [self.pack_header(args[0], len(args))]
+        if len(args) > 1:
+            self.pack_key(args[1], output)
+            for arg in args[2:]:
+                self.pack_arg(arg, output)
+        return output
+
+    def prepare(self, *args):
+        return PreparedCommand(self, *args)
+
+
+class PreparedCommand:
+    """
+    Command with fixed leading `args` packed once:
+
+    >>> hget_users = packer.prepare('HGET', 'users')
+    >>> chunks = hget_users.pack('user_id')  # HGET users user_id
+    """
+    def __init__(self, packer, *args):
+        self.packer = packer
+        self.args = args
+        output = []
+        for arg in args[1:]:
+            packer.pack_arg(arg, output)
+        self._packed_args = SYM_EMPTY.join(output)
+        self._headers = {}  # number of variable args -> packed prefix
+
+    def pack(self, *args):
+        "Pack the command with the variable `args` into a list of chunks"
+        try:
+            prefix = self._headers[len(args)]
+        except KeyError:
+            prefix = self._headers[len(args)] = SYM_EMPTY.join((
+                self.packer.pack_header(
+                    self.args[0], len(self.args) + len(args)),
+                self._packed_args))
+        output = [prefix]
+        if args and len(self.args) == 1:
+            self.packer.pack_key(args[0], output)
+            args = args[1:]
+        for arg in args:
+            self.packer.pack_arg(arg, output)
+        return output
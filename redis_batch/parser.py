@@ -2,9 +2,7 @@ import sys
 import asyncio
 
 from redis.connection import BaseParser
-from redis.connection import PythonParser
-from redis._compat import (b, xrange, imap, byte_to_chr, unicode, bytes, long,
-                           BytesIO, nativestr, basestring,
+from redis._compat import (b, imap, unicode, bytes, basestring,
                            LifoQueue, Empty, Full)
 from redis.exceptions import (
     RedisError,
@@ -20,118 +18,142 @@ from redis.connection import (
     SYM_STAR,
     SYM_DOLLAR,
     SYM_CRLF,
-    SYM_LF,
     SYM_EMPTY,
 )
 from redis.utils import HIREDIS_AVAILABLE
 if HIREDIS_AVAILABLE:
     import hiredis
 
-__all__ = ['AsyncHiredisParser', 'AuthenticationError']
+__all__ = ['AsyncHiredisParser', 'AsyncBufferedPythonParser', 'PythonReader',
+           'AuthenticationError']
 
 
-class AsyncPythonParser(PythonParser):
-    def on_connect(self, connection):
-        "Called when the socket connects"
-        self._fp = connection.get_reader()
-        if connection.decode_responses:
-            self.encoding = connection.encoding
+# marks an array started by `PythonReader._parse`
+_ARRAY = object()
 
-    def on_disconnect(self):
-        "Called when the socket disconnects"
-        self._fp = None
 
-    @asyncio.coroutine
-    def read(self, length=None):
+class PythonReader:
+    """
+    Pure-Python RESP reader with the `hiredis.Reader` interface:
+
+    >>> reader.feed(data)
+    >>> reply = reader.gets()  # False until a complete reply is buffered
+
+    Data is kept in one `bytearray` consumed from a read offset, arrays
+    (nested or not) being parsed are kept on a stack so data arriving in
+    many pieces is never parsed twice.
+    """
+    def __init__(self, protocolError=InvalidResponse, replyError=ResponseError,
+                 encoding=None):
+        self.protocolError = protocolError
+        self.replyError = replyError
+        self.encoding = encoding
+        self._buffer = bytearray()
+        self._offset = 0
+        self._stack = []  # [items, length] of the arrays being parsed
+
+    def feed(self, data):
+        self._buffer += data
+
+    def gets(self):
         """
-        Read a line from the socket if no length is specified,
-        otherwise read ``length`` bytes. Always strip away the newlines.
+        :returns: next complete reply or False
         """
-        # @TODO: rename to ._read (as its not part of BaseParser)
-        # @TODO: make public interface of BaseParser explicit
-        try:
-            if length is not None:
-                bytes_left = length + 2  # read the line ending
-                if length > self.MAX_READ_LENGTH:
-                    # apparently reading more than 1MB or so from a windows
-                    # socket can cause MemoryErrors. See:
-                    # https://github.com/andymccurdy/redis-py/issues/205
-                    # read smaller chunks at a time to work around this
-                    try:
-                        buf = BytesIO()
-                        while bytes_left > 0:
-                            read_len = min(bytes_left, self.MAX_READ_LENGTH)
-                            buf.write((yield from self._fp.read(read_len)))
-                            bytes_left -= read_len
-                        buf.seek(0)
-                        return buf.read(length)
-                    finally:
-                        buf.close()
-                return (yield from self._fp.read(bytes_left))[:-2]
-
-            # no length, read a full line
-            return (yield from self._fp.readline())[:-2]
-        except Exception:
-            e = sys.exc_info()[1]
-            raise ConnectionError("Error while reading from socket: %s" %
-                                  (e.args,))
-
-    def process_response_data(self, response):
-        # @TODO: suggest API change to add .process_response_data
-        byte, response = byte_to_chr(response[0]), response[1:]
-
-        if byte not in ('-', '+', ':', '$', '*'):
-            raise InvalidResponse("Protocol Error: %s, %s" %
-                                  (str(byte), str(response)))
-
-        # server returned an error
-        if byte == '-':
-            response = nativestr(response)
-            error = self.parse_error(response)
-            # if the error is a ConnectionError, raise immediately so the user
-            # is notified
-            if isinstance(error, ConnectionError):
-                raise error
-            # otherwise, we're dealing with a ResponseError that might belong
-            # inside a pipeline response. the connection's read_response()
-            # and/or the pipeline's execute() will raise this error if
-            # necessary, so just return the exception instance here.
-            return error
-        # single value
-        elif byte == '+':
-            pass
-        # int value
-        elif byte == ':':
-            response = long(response)
-        # bulk response
-        elif byte == '$':
-            length = int(response)
+        stack = self._stack
+        while True:
+            reply = self._parse()
+            if reply is False:
+                break
+            if reply is _ARRAY:
+                continue
+            while stack:
+                items, length = stack[-1]
+                items.append(reply)
+                if len(items) < length:
+                    break
+                stack.pop()
+                reply = items
+            else:
+                self._compact()
+                return reply
+        self._compact()
+        return False
+
+    def _compact(self):
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif self._offset > 65536:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+    def _parse(self):
+        """
+        Parse one element at the offset, starting an array pushes it on
+        the stack and returns `_ARRAY`.
+
+        :returns: element, `_ARRAY` or False if incomplete
+        """
+        buffer = self._buffer
+        offset = self._offset
+        end = buffer.find(SYM_CRLF, offset)
+        if end == -1:
+            return False
+        byte = buffer[offset]
+        if byte == 36:  # $
+            length = int(buffer[offset + 1:end])
             if length == -1:
+                self._offset = end + 2
                 return None
-            response = self.read(length)
-        # multi-bulk response
-        elif byte == '*':
-            length = int(response)
+            start = end + 2
+            end = start + length
+            if len(buffer) < end + 2:
+                return False
+            self._offset = end + 2
+            response = bytes(buffer[start:end])
+        elif byte == 42:  # *
+            length = int(buffer[offset + 1:end])
+            self._offset = end + 2
             if length == -1:
                 return None
-            response = [self.read_response() for i in xrange(length)]
-        if isinstance(response, bytes) and self.encoding:
+            if length == 0:
+                return []
+            self._stack.append(([], length))
+            return _ARRAY
+        elif byte == 58:  # :
+            self._offset = end + 2
+            return int(buffer[offset + 1:end])
+        elif byte == 43:  # +
+            self._offset = end + 2
+            response = bytes(buffer[offset + 1:end])
+        elif byte == 45:  # -
+            self._offset = end + 2
+            return self.replyError(
+                bytes(buffer[offset + 1:end]).decode('utf-8', 'replace'))
+        else:
+            raise self.protocolError("Protocol error, got %r as reply type "
+                                     "byte" % chr(byte))
+        if self.encoding:
             response = response.decode(self.encoding)
         return response
 
-    @asyncio.coroutine
-    def read_response(self):
-        response = yield from self.read()
-        if not response:
-            raise ConnectionError("Socket closed on remote end")
-        return self.process_response_data(response)
 
+class AsyncReaderParser(BaseParser):
+    """
+    Base for parsers feeding socket data into a `hiredis.Reader` like reader.
+
+    Reads are sized from the number of replies still expected and the
+    average reply size seen so far, so a batch of replies (or a big bulk
+    reply) takes a few big reads instead of many 4KB ones.
+    """
+    min_read_size = 4096
+    max_read_size = 1024 * 1024
+    smoothing = 0.2
 
-class AsyncHiredisParser(BaseParser):
-    "Parser class for connections using Hiredis"
     def __init__(self):
-        if not HIREDIS_AVAILABLE:
-            raise RedisError("Hiredis is not installed")
+        self._fp = None
+        self._reader = None
+        self.reply_size = 64  # average bytes per reply (EWMA)
 
     def __del__(self):
         try:
@@ -139,47 +161,99 @@ class AsyncHiredisParser(BaseParser):
         except Exception:
             pass
 
+    def make_reader(self, encoding=None):
+        raise NotImplementedError()
+
     def on_connect(self, connection):
         "Called when the socket connects"
         self._fp = connection.get_reader()
-        kwargs = {
-            'protocolError': InvalidResponse,
-            'replyError': ResponseError,
-        }
-
+        encoding = None
         if connection.decode_responses:
-            kwargs['encoding'] = connection.encoding
-        self._reader = hiredis.Reader(**kwargs)
+            encoding = connection.encoding
+        self._reader = self.make_reader(encoding)
 
     def on_disconnect(self):
         self._fp = None
         self._reader = None
 
+    def read_size(self, n):
+        "Size of the next read, `n` replies still expected"
+        size = int(n * self.reply_size)
+        return min(max(size, self.min_read_size), self.max_read_size)
+
     @asyncio.coroutine
-    def read_response(self):
+    def read_responses(self, n, on_reply=None):
+        """
+        Read `n` replies, error replies are returned (not raised).
+        `on_reply(i, response)` is called as soon as each one is parsed.
+        """
         if not self._reader:
             raise ConnectionError("Socket closed on remote end")
-        response = self._reader.gets()
-        while response is False:
-            try:
-                buffer = yield from self._fp.read(4096)
-            except Exception:
-                e = sys.exc_info()[1]
-                raise ConnectionError("Error while reading from socket: %s" %
-                                      (e.args,))
-            if not buffer:
-                raise ConnectionError("Socket closed on remote end")
-            self._reader.feed(buffer)
-            # proactively, but not conclusively, check if more data is in the
-            # buffer. if the data received doesn't end with \n, there's more.
-            if not buffer.endswith(SYM_LF):
-                continue
+        responses = []
+        received = 0
+        while True:
             response = self._reader.gets()
-        if isinstance(response, ResponseError):
-            response = self.parse_error(response.args[0])
-        return response
+            if response is False:
+                try:
+                    buffer = yield from self._fp.read(
+                        self.read_size(n - len(responses)))
+                except asyncio.CancelledError:
+                    raise  # an Exception before python 3.8
+                except Exception:
+                    e = sys.exc_info()[1]
+                    raise ConnectionError(
+                        "Error while reading from socket: %s" % (e.args,))
+                if not buffer:
+                    raise ConnectionError("Socket closed on remote end")
+                received += len(buffer)
+                self._reader.feed(buffer)
+                continue
+            if isinstance(response, ResponseError):
+                response = self.parse_error(response.args[0])
+                if isinstance(response, ConnectionError):
+                    raise response
+            if on_reply is not None:
+                on_reply(len(responses), response)
+            responses.append(response)
+            if len(responses) == n:
+                break
+        if received:
+            self.reply_size += self.smoothing * (
+                received / n - self.reply_size)
+        return responses
+
+    @asyncio.coroutine
+    def read_response(self):
+        return (yield from self.read_responses(1))[0]
+
+
+class AsyncHiredisParser(AsyncReaderParser):
+    "Parser class for connections using Hiredis"
+    def __init__(self):
+        if not HIREDIS_AVAILABLE:
+            raise RedisError("Hiredis is not installed")
+        super().__init__()
+
+    def make_reader(self, encoding=None):
+        kwargs = {
+            'protocolError': InvalidResponse,
+            'replyError': ResponseError,
+        }
+        if encoding:
+            kwargs['encoding'] = encoding
+        return hiredis.Reader(**kwargs)
+
+
+class AsyncBufferedPythonParser(AsyncReaderParser):
+    """
+    Pure-Python parser reading the socket in big chunks into `PythonReader`,
+    all the replies received are parsed in one pass
+    """
+    def make_reader(self, encoding=None):
+        return PythonReader(encoding=encoding)
+
 
 if HIREDIS_AVAILABLE:
     DefaultParser = AsyncHiredisParser
 else:
-    DefaultParser = AsyncPythonParser
+    DefaultParser = AsyncBufferedPythonParser
@@ -1,10 +1,14 @@
 import sys
+import types
+import functools
 import itertools
+import collections
 
 import redis
 import redis.client
 import asyncio
-from redis.client import b, izip
+from redis.client import izip
+from redis._compat import nativestr
 from redis.exceptions import (
     ConnectionError,
     ResponseError,
@@ -12,20 +16,103 @@ from redis.exceptions import (
     ExecAbortError,
 )
 
+from redis_batch.retry import RetryPolicy
 
-SYM_EMPTY = b('')
+# execution modes
+MODE_TRANSACTION = 'transaction'  # wrap every batch in MULTI/EXEC
+MODE_PIPELINE = 'pipeline'  # plain pipelining, no MULTI/EXEC
+MODE_AUTO = 'auto'  # MULTI/EXEC only for batches with `atomic` commands
+MODES = (MODE_TRANSACTION, MODE_PIPELINE, MODE_AUTO)
+
+# per-command options consumed by the pipeline, never passed to callbacks
+PIPELINE_OPTIONS = frozenset(
+    ['atomic', 'packed', 'columnar', 'timeout', 'lane', 'group'])
+
+# shared by the command records queued without options
+NO_OPTIONS = types.MappingProxyType({})
+# shared by the commands of the groups queued by `push_group`
+ATOMIC_OPTIONS = types.MappingProxyType({'atomic': True})
+
+
+def callback_options(options):
+    """`options` without the ones in `PIPELINE_OPTIONS`"""
+    if PIPELINE_OPTIONS.isdisjoint(options):
+        return options
+    return {k: v for k, v in options.items() if k not in PIPELINE_OPTIONS}
+
+
+class ConnectionSlot:
+    """Connection pinned to a share of the keys, one batch in flight"""
+    def __init__(self, loop=None):
+        self.lock = asyncio.Lock(loop=loop)
+        self.connection = None
+        # batches executing on the slot connections (a replaced connection
+        # is released once the batches still using it are done)
+        self.users = collections.Counter()
 
 
 class AsyncBasePipeline(redis.client.BasePipeline):
-    def __init__(self, stack, *args, loop=None, **kwargs):
+    def __init__(self, stack, *args, loop=None, mode=None, max_inflight=None,
+                 multiplex=False, executor=None, offload_commands=(),
+                 offload_threshold=None, resolve_slice=None,
+                 max_loop_lag=0.005, retry_policy=None, **kwargs):
+        """
+        Without `max_inflight` each drained batch takes a connection from
+        the pool. With `max_inflight=N` batches are split over N slots, each
+        with its own pinned connection and one batch in flight, so at most
+        N batches run concurrently and commands on the same key keep their
+        order. A batch executed as a transaction is not split: it runs on
+        the slot of its first command while no other batch is in flight on
+        the slots of its commands, so transactions spanning all the slots
+        run one at a time.
+
+        With `multiplex` slots (one by default) do not wait for a batch
+        replies before sending the next batch over the same connection.
+        Several multiplexed slots require the 'pipeline' mode, as nothing
+        would keep a transaction spanning slots in order with the batches
+        sent on the others.
+
+        Response callbacks of `offload_commands` and of replies longer than
+        `offload_threshold` (bytes or elements) run in `executor` (loop
+        default one if None) instead of on the loop. A process pool only
+        suits commands with picklable callbacks.
+
+        With `resolve_slice` batch futures are resolved that many at a time,
+        yielding to the loop in between. Slices shrink while the loop lags
+        more than `max_loop_lag` seconds and grow back once it does not.
+
+        Batches failed with a `ConnectionError` are retried as allowed by the
+        `retry_policy` (`RetryPolicy()` if None).
+        """
         self.command_stack = stack
         stack.pipe = self
         self._loop = loop
-        # Full implementation would maintain a set of queues
-        # and put to the wright one.
-        # This uses only one cmd-queue. consider making cmd-queue
-        # be optionally external to client like the connection_pool.
+        # `stack` is a single cmd-queue or a `PipeLaneQueue` of several.
+        # consider making cmd-queue be optionally external to client like
+        # the connection_pool.
         super().__init__(*args, **kwargs)
+        if mode is None:
+            mode = MODE_TRANSACTION if self.transaction else MODE_PIPELINE
+        if mode not in MODES:
+            raise ValueError('unknown mode: {}'.format(mode))
+        self.mode = mode
+        if multiplex and (max_inflight or 1) > 1 and mode != MODE_PIPELINE:
+            raise ValueError("multiplex with max_inflight > 1 requires "
+                             "the 'pipeline' mode")
+        self.multiplex = multiplex
+        if multiplex and not max_inflight:
+            max_inflight = 1
+        self.slots = [ConnectionSlot(loop=loop)
+                      for i in range(max_inflight or 0)]
+        self.executor = executor
+        self.offload_commands = frozenset(offload_commands)
+        self.offload_threshold = offload_threshold
+        self.resolve_slice = resolve_slice
+        self.retry_policy = retry_policy or RetryPolicy()
+        # error replies, retries, failed batches and the futures they failed
+        self.stats = collections.Counter()
+        self.max_loop_lag = max_loop_lag
+        self.slice_size = resolve_slice
 
     def reset(self):
         command_stack = self.command_stack  # self.command_stack.clear?
@@ -37,24 +124,251 @@ class AsyncBasePipeline(redis.client.BasePipeline):
         yield from self.command_stack.put((fut, args, options))
         return self
 
+    def push_command(self, fut, args, options):
+        """
+        Synchronous fast-path of `pipeline_execute_command`: appends the
+        `(fut, args, options)` command record straight to the stack
+        """
+        self.command_stack.push((fut, args, options or NO_OPTIONS))
+
+    def push_group(self, fut, commands, options):
+        """
+        Append `(fut, args)` `commands` as one record so the queue flushes
+        them in the same batch, executed as a transaction unless in
+        'pipeline' mode. The record has the args of the first command (for
+        lanes), `options` and the `group` option holding the records of
+        `commands`, executed in its place by `execute_stack`.
+        """
+        group = [(f, args, ATOMIC_OPTIONS) for f, args in commands]
+        self.command_stack.push(
+            (fut, group[0][1], dict(options, group=group)))
+
     @asyncio.coroutine
     def execute_stack(self, stack, raise_on_error=True):
-        """Execute all the commands from the given `stack`"""
+        """
+        Execute all the commands from the given `stack`. Every command future
+        gets resolved: with its reply, its own error reply or the error that
+        failed its batch. With `raise_on_error` errors are raised too.
+
+        Command groups (see `push_group`) are executed in place of their
+        record. Commands whose futures are already done (cancelled, timed
+        out) are not sent.
+        """
+        stack = self.expand_groups(stack)
+        pending = [command for command in stack if not command[0].done()]
+        if len(pending) < len(stack):
+            self.stats['pruned'] += len(stack) - len(pending)
+            stack = pending
         if not stack:
             return []
         if self.scripts:
             self.load_scripts()
-        if self.transaction or self.explicit_transaction:
+
+        try:
+            if not self.slots:
+                return (yield from self._execute_on_pool(
+                    stack, raise_on_error))
+
+            if self.uses_transaction(stack):
+                # splitting it over the slots would break its atomicity,
+                # the locks of the slots of its commands keep their order
+                slot = self.slots[self.route(stack[0][1])]
+                routes = sorted(set(
+                    self.route(args) for f, args, options in stack))
+                locks = [] if self.multiplex else [
+                    self.slots[i].lock for i in routes]
+                return [(yield from self._execute_on_slot(
+                    slot, stack, raise_on_error, locks))]
+
+            routed = collections.defaultdict(list)
+            for command in stack:
+                routed[self.route(command[1])].append(command)
+            return (yield from asyncio.gather(
+                *[self._execute_on_slot(self.slots[i], commands,
+                                        raise_on_error)
+                  for i, commands in routed.items()],
+                loop=self._loop))
+        except Exception:
+            if raise_on_error:
+                raise
+        finally:
+            self.reset()
+
+    def expand_groups(self, stack):
+        """`stack` with the group records replaced by their commands"""
+        if not any('group' in options for f, args, options in stack):
+            return stack
+        expanded = []
+        for command in stack:
+            group = command[2].get('group')
+            if group is None:
+                expanded.append(command)
+            else:
+                expanded.extend(group)
+        return expanded
+
+    @asyncio.coroutine
+    def _execute_on_pool(self, commands, raise_on_error):
+        @asyncio.coroutine
+        def execute(commands):
+            conn = yield from self.acquire_connection()
+            try:
+                return (yield from self._execute_on(
+                    conn, commands, raise_on_error))
+            finally:
+                self.connection_pool.release(conn)
+
+        try:
+            return (yield from self._execute_with_retry(execute, commands))
+        except Exception:
+            self.fail_futures(commands, sys.exc_info()[1])
+            raise
+
+    @asyncio.coroutine
+    def _execute_with_retry(self, execute, commands):
+        """
+        `execute(commands)` retried after a `ConnectionError` (on a fresh
+        connection) as far as the `retry_policy` allows
+        """
+        attempt = 0
+        while True:
+            try:
+                return (yield from execute(commands))
+            except ConnectionError:
+                exc = sys.exc_info()[1]
+                if self.retry_policy is None:
+                    raise
+                replay, failed = self.retry_policy.split(
+                    commands, exc, self.uses_transaction(commands))
+                if not replay or not self.retry_policy.allow(
+                        attempt, self._loop.time()):
+                    raise
+                # fail fast the ones not safe to replay
+                self.fail_futures(failed, exc)
+                commands = replay
+                self.stats['retries'] += 1
+                yield from asyncio.sleep(
+                    self.retry_policy.delay(attempt), loop=self._loop)
+                attempt += 1
+
+    def fail_futures(self, commands, exc):
+        """Set `exc` on the futures of a failed batch not resolved yet"""
+        failed = 0
+        for fut, args, options in commands:
+            if not fut.done():
+                fut.set_exception(exc)
+                failed += 1
+        if failed:
+            self.stats['failed_batches'] += 1
+            self.stats['failed_futures'] += failed
+            self.stats['failed_futures.' + type(exc).__name__] += failed
+
+    @asyncio.coroutine
+    def acquire_connection(self):
+        """
+        Get a connection from the pool, waiting for one without blocking
+        the loop when the pool supports it (`AsyncConnectionPool.acquire`)
+        """
+        acquire = getattr(self.connection_pool, 'acquire', None)
+        if acquire is not None:
+            return (yield from acquire())
+        return self.connection_pool.get_connection('MULTI', self.shard_hint)
+
+    def route(self, args):
+        """
+        Index of the slot executing the command with given `args`. Commands
+        on the same (first) key always use the same slot, keyless commands
+        use the first one.
+        """
+        if len(args) < 2 or len(self.slots) == 1:
+            return 0
+        key = args[1]
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return hash(key) % len(self.slots)
+
+    @asyncio.coroutine
+    def _execute_on_slot(self, slot, commands, raise_on_error, locks=None):
+        """
+        Execute `commands` on `slot` holding `locks`, the slot lock by
+        default. Locks are always taken in the order of the slots.
+        """
+        if locks is None:
+            # the multiplexed connection keeps replies in order of batches
+            locks = [] if self.multiplex else [slot.lock]
+        execute = functools.partial(
+            self._execute_on_slot_connection, slot,
+            raise_on_error=raise_on_error)
+        acquired = []
+        try:
+            for lock in locks:
+                yield from lock.acquire()
+                acquired.append(lock)
+            return (yield from self._execute_with_retry(execute, commands))
+        except Exception:
+            self.fail_futures(commands, sys.exc_info()[1])
+            raise
+        finally:
+            for lock in acquired:
+                lock.release()
+
+    @asyncio.coroutine
+    def _execute_on_slot_connection(self, slot, commands, raise_on_error):
+        if slot.connection is None:
+            conn = yield from self.acquire_connection()
+            if slot.connection is None:
+                slot.connection = conn
+            else:  # acquired by another batch meanwhile
+                self.connection_pool.release(conn)
+        conn = slot.connection
+        slot.users[conn] += 1
+        try:
+            return (yield from self._execute_on(
+                conn, commands, raise_on_error))
+        except ConnectionError:
+            if slot.connection is conn:
+                # next batches (retries included) use another connection
+                slot.connection = None
+            raise
+        finally:
+            slot.users[conn] -= 1
+            if not slot.users[conn]:
+                del slot.users[conn]
+                if slot.connection is not conn:
+                    # no turns pending on it anymore
+                    self.connection_pool.release(conn)
+
+    def release_slots(self):
+        """
+        Give connections pinned to slots back to the connection pool, the
+        ones still executing batches are released by the last of these
+        """
+        for slot in self.slots:
+            conn, slot.connection = slot.connection, None
+            if conn is not None and not slot.users[conn]:
+                self.connection_pool.release(conn)
+
+    def uses_transaction(self, commands):
+        """True if `commands` are executed wrapped in MULTI/EXEC"""
+        if self.explicit_transaction or self.mode == MODE_TRANSACTION:
+            return True
+        return self.mode == MODE_AUTO and self.is_atomic(commands)
+
+    @asyncio.coroutine
+    def _execute_on(self, conn, stack, raise_on_error):
+        if self.uses_transaction(stack):
             execute = self._execute_transaction
         else:
             execute = self._execute_pipeline
 
-        conn = self.connection_pool.get_connection('MULTI', self.shard_hint)
-
+        generation = getattr(conn, 'generation', None)
         try:
             return (yield from execute(conn, stack, raise_on_error))
         except ConnectionError:
-            conn.disconnect()
+            # unless another batch disconnected it already, the connection
+            # may be a new one by now
+            if getattr(conn, 'generation', None) == generation:
+                conn.disconnect()
             # if we were watching a variable, the watch is no longer valid
             # since this connection has died. raise a WatchError, which
             # indicates the user should retry his transaction. If this is more
@@ -63,12 +377,143 @@ class AsyncBasePipeline(redis.client.BasePipeline):
             if self.watching:
                 raise WatchError("A ConnectionError occured on while watching "
                                  "one or more keys")
-            # otherwise, it's safe to retry since the transaction isn't
-            # predicated on any state
-            return (yield from execute(conn, stack, raise_on_error))
-        finally:
-            self.reset()
-            self.connection_pool.release(conn)
+            # otherwise it is up to the `retry_policy`
+            raise
+
+    def is_atomic(self, commands):
+        """True if any of `commands` was queued with `atomic=True`"""
+        return any(options.get('atomic') for f, args, options in commands)
+
+    def resolve_future(self, command, r):
+        """
+        Set command future (running response callback manually), commands
+        queued with a `columnar` option get the raw reply converted by it
+        instead (see `redis_batch.columnar`). A failing callback fails the
+        future of its command only.
+        """
+        fut, args, options = command
+        if fut.done():  # cancelled by the caller
+            return
+        if isinstance(r, Exception):
+            self.stats['error_replies'] += 1
+            fut.set_exception(r)
+        else:
+            command_name = args[0]
+            if self.offload(command, r):
+                self.resolve_in_executor(command, r)
+                return
+            try:
+                if 'columnar' in options:
+                    r = options['columnar'](r)
+                elif command_name in self.response_callbacks:
+                    r = self.response_callbacks[command_name](
+                        r, **callback_options(options))
+            except Exception:
+                self.stats['callback_errors'] += 1
+                fut.set_exception(sys.exc_info()[1])
+            else:
+                fut.set_result(r)
+
+    def offload(self, command, r):
+        """Whether to post-process reply `r` in the executor"""
+        fut, args, options = command
+        if not self.offload_commands and self.offload_threshold is None:
+            return False
+        command_name = args[0]
+        if ('columnar' not in options and
+                command_name not in self.response_callbacks):
+            return False
+        if command_name in self.offload_commands:
+            return True
+        return (self.offload_threshold is not None and
+                isinstance(r, (bytes, list)) and
+                len(r) > self.offload_threshold)
+
+    def resolve_in_executor(self, command, r):
+        """Run the response callback in the executor, resolve on the loop"""
+        fut, args, options = command
+        if 'columnar' in options:
+            callback = options['columnar']
+        else:
+            callback = functools.partial(self.response_callbacks[args[0]],
+                                         **callback_options(options))
+
+        def resolve(executor_fut):
+            if fut.done():
+                return
+            if executor_fut.cancelled():  # e.g. executor shut down
+                fut.cancel()
+                return
+            exc = executor_fut.exception()
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(executor_fut.result())
+
+        executor_fut = self._loop.run_in_executor(self.executor, callback, r)
+        executor_fut.add_done_callback(resolve)
+
+    def annotate_reply(self, commands, i, r):
+        """Annotate the `i`-th of `commands` error reply `r`"""
+        if isinstance(r, ResponseError):
+            self.annotate_exception(r, i + 1, commands[i][1])
+
+    def resolve_reply(self, commands, i, r):
+        """Resolve the `i`-th of `commands` with its reply `r`"""
+        self.annotate_reply(commands, i, r)
+        self.resolve_future(commands[i], r)
+
+    def resolve_futures(self, commands, response):
+        for r, cmd in izip(response, commands):
+            self.resolve_future(cmd, r)
+
+    @asyncio.coroutine
+    def resolve_batch(self, commands, response):
+        """
+        `resolve_futures` by `slice_size` slices, yielding to the loop in
+        between (at once without `resolve_slice`)
+        """
+        if self.resolve_slice is None:
+            self.resolve_futures(commands, response)
+            return
+        start = 0
+        while start < len(commands):
+            end = start + self.slice_size
+            self.resolve_futures(commands[start:end], response[start:end])
+            start = end
+            if start < len(commands):
+                t0 = self._loop.time()
+                yield from asyncio.sleep(0, loop=self._loop)
+                self.adapt_slice(self._loop.time() - t0)
+
+    def adapt_slice(self, lag):
+        """Halve the slice while the loop `lag` is too big, else double it"""
+        if lag > self.max_loop_lag:
+            self.slice_size = max(1, self.slice_size // 2)
+        else:
+            self.slice_size = min(self.resolve_slice, self.slice_size * 2)
+
+    def pack_batch(self, connection, commands):
+        """
+        Pack `(fut, args, options)` commands into a list of chunks (see
+        `AsyncConnection.pack_commands`), prefixed with a PING when the
+        connection `needs_health_check`. Commands queued with a `packed`
+        option (see `PreparedCommand`) are not packed again.
+
+        :returns: (packed, health_check)
+        """
+        all_args = [options.get('packed', args)
+                    for f, args, options in commands]
+        health_check = getattr(connection, 'needs_health_check', False)
+        if health_check:
+            connection.needs_health_check = False
+            all_args.insert(0, ('PING', ))
+        return connection.pack_commands(all_args), health_check
+
+    @asyncio.coroutine
+    def read_health_check(self, connection):
+        if nativestr((yield from connection.read_response())) != 'PONG':
+            raise ConnectionError("Bad response to health check PING")
 
     @asyncio.coroutine
     def _execute_transaction(self, connection, commands, raise_on_error):
@@ -76,43 +521,37 @@ class AsyncBasePipeline(redis.client.BasePipeline):
             [(None, ('MULTI', ), {})],
             commands,
             [(None, ('EXEC', ), {})])
-        all_cmds = SYM_EMPTY.join(
-            itertools.starmap(
-                connection.pack_command,
-                [args for f, args, options in cmds]))
-        yield from connection.send_packed_command(all_cmds)
+        all_cmds, health_check = self.pack_batch(connection, cmds)
+        turn = yield from connection.send_packed_batch(all_cmds)
         errors = []
 
-        # parse off the response for MULTI
-        # NOTE: we need to handle ResponseErrors here and continue
-        # so that we read all the additional command messages from
-        # the socket
-        try:
-            # yield from self.parse_response(connection, '_')
-            yield from connection.read_response()
-        except ResponseError:
-            errors.append((0, sys.exc_info()[1]))
+        with turn:
+            yield from turn.wait()
+            if health_check:
+                yield from self.read_health_check(connection)
+            # MULTI, QUEUED for every command and EXEC replies. ResponseErrors
+            # are returned, not raised, so all the replies are read
+            replies = yield from connection.read_responses(len(commands) + 2)
+            turn.release()
 
-        # and all the other commands
+        if isinstance(replies[0], ResponseError):
+            errors.append((0, replies[0]))
         for i, command in enumerate(commands):
-            try:
-                # yield from self.parse_response(connection, '_')
-                yield from connection.read_response()
-            except ResponseError:
-                ex = sys.exc_info()[1]
-                self.annotate_exception(ex, i + 1, command[0])
-                errors.append((i, ex))
-
-        # parse the EXEC.
-        try:
-            # response = yield from self.parse_response(connection, '_')
-            response = yield from connection.read_response()
-        except ExecAbortError:
+            r = replies[i + 1]
+            if isinstance(r, ResponseError):
+                self.annotate_exception(r, i + 1, command[1])
+                errors.append((i, r))
+        annotated = set(i for i, e in errors)
+
+        response = replies[-1]
+        if isinstance(response, ExecAbortError):
             if self.explicit_transaction:
                 self.immediate_execute_command('DISCARD')
             if errors:
                 raise errors[0][1]
-            raise sys.exc_info()[1]
+            raise response
+        if isinstance(response, ResponseError):
+            raise response
 
         if response is None:
             raise WatchError("Watched variable changed.")
@@ -122,24 +561,46 @@ class AsyncBasePipeline(redis.client.BasePipeline):
             response.insert(i, e)
 
         if len(response) != len(commands):
-            self.connection.disconnect()
+            connection.disconnect()
             raise ResponseError("Wrong number of response items from "
                                 "pipeline execution")
 
-        # find any errors in the response and raise if necessary
-        if raise_on_error:
-            self.raise_first_error(commands, response)
+        # every future gets its own reply or error, raised if necessary
+        # once all are resolved
+        first_error = None
+        for i, r in enumerate(response):
+            if isinstance(r, ResponseError):
+                if i not in annotated:
+                    self.annotate_exception(r, i + 1, commands[i][1])
+                first_error = first_error or r
+        yield from self.resolve_batch(commands, response)
+        if raise_on_error and first_error is not None:
+            raise first_error
+        return response
 
-        # We have to run response callbacks manually
-        for r, cmd in izip(response, commands):
-            fut, args, options = cmd
-            if isinstance(r, Exception):
-                fut.set_exception(r)
-            else:
-                command_name = args[0]
-                if command_name in self.response_callbacks:
-                    r = self.response_callbacks[command_name](r, **options)
-                fut.set_result(r)
+    @asyncio.coroutine
+    def _execute_pipeline(self, connection, commands, raise_on_error):
+        all_cmds, health_check = self.pack_batch(connection, commands)
+        turn = yield from connection.send_packed_batch(all_cmds)
+
+        # without MULTI/EXEC each reply stands alone: resolve the command
+        # future as soon as its reply is parsed (or by slices after all
+        # were read with `resolve_slice`). Errors are set on the failing
+        # command future only so `raise_on_error` does not apply.
+        if self.resolve_slice is None:
+            on_reply = functools.partial(self.resolve_reply, commands)
+        else:
+            on_reply = functools.partial(self.annotate_reply, commands)
+        with turn:
+            yield from turn.wait()
+            if health_check:
+                yield from self.read_health_check(connection)
+            response = yield from connection.read_responses(
+                len(commands), on_reply)
+            turn.release()
+        if self.resolve_slice is not None:
+            yield from self.resolve_batch(commands, response)
+        return response
 
 
 class AsyncStrictPipeline(AsyncBasePipeline, redis.StrictRedis):
@@ -0,0 +1,98 @@
+"""
+Retrying batches failed with a `ConnectionError`: jittered exponential
+backoff, replay limited to the commands safe to run twice, and a shared
+budget of retries so a Redis outage does not cause a reconnect storm.
+"""
+import random
+
+from redis._compat import nativestr
+
+from redis_batch.connection import ConnectError
+
+__all__ = ['RetryPolicy', 'IDEMPOTENT_COMMANDS']
+
+# read-only commands, replayed even if they might have been executed
+IDEMPOTENT_COMMANDS = frozenset([
+    'PING', 'ECHO', 'INFO', 'DBSIZE', 'TIME',
+    'EXISTS', 'TYPE', 'TTL', 'PTTL', 'KEYS', 'SCAN', 'DUMP',
+    'GET', 'MGET', 'GETRANGE', 'STRLEN', 'GETBIT', 'BITCOUNT',
+    'HGET', 'HMGET', 'HGETALL', 'HKEYS', 'HVALS', 'HLEN', 'HEXISTS', 'HSCAN',
+    'LRANGE', 'LLEN', 'LINDEX',
+    'SMEMBERS', 'SISMEMBER', 'SCARD', 'SRANDMEMBER', 'SSCAN',
+    'SDIFF', 'SINTER', 'SUNION',
+    'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE', 'ZSCORE',
+    'ZRANK', 'ZREVRANK', 'ZCARD', 'ZCOUNT', 'ZSCAN',
+])
+
+
+class RetryPolicy:
+    """
+    Retry batches up to `retries` times after a `ConnectionError`, waiting
+    a random (full jitter) delay up to `backoff * 2 ** attempt` seconds
+    capped at `max_backoff`.
+
+    Commands of a batch that could not be sent (`ConnectError`) are all
+    replayed, otherwise only the unresolved `idempotent_commands` are, the
+    others fail fast. A transaction is replayed only if all its commands
+    are idempotent.
+
+    At most `max_retry_rate` retries per second (bursts of `max_retry_burst`)
+    are made across all the batches using the policy, beyond that batches
+    fail fast.
+    """
+    def __init__(self, retries=1, backoff=0.01, max_backoff=1.0,
+                 idempotent_commands=IDEMPOTENT_COMMANDS,
+                 max_retry_rate=100, max_retry_burst=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idempotent_commands = frozenset(idempotent_commands)
+        self.max_retry_rate = max_retry_rate
+        self.max_retry_burst = max_retry_burst
+        self._tokens = max_retry_burst
+        self._tokens_time = None
+
+    def is_idempotent(self, args):
+        return nativestr(args[0]).upper() in self.idempotent_commands
+
+    def split(self, commands, exc, transaction=False):
+        """
+        Split the unresolved `(fut, args, options)` `commands` of a batch
+        failed with `exc` into the ones to replay and the ones to fail
+
+        :returns: (replay, fail)
+        """
+        pending = [command for command in commands if not command[0].done()]
+        if isinstance(exc, ConnectError):
+            return pending, []
+        if transaction:
+            if all(self.is_idempotent(args) for f, args, o in pending):
+                return pending, []
+            return [], pending
+        replay, fail = [], []
+        for command in pending:
+            if self.is_idempotent(command[1]):
+                replay.append(command)
+            else:
+                fail.append(command)
+        return replay, fail
+
+    def allow(self, attempt, now):
+        """Whether retry `attempt` (0 based) can be made at time `now`"""
+        if attempt >= self.retries:
+            return False
+        if self._tokens_time is not None:
+            self._tokens = min(
+                self.max_retry_burst,
+                self._tokens +
+                (now - self._tokens_time) * self.max_retry_rate)
+        self._tokens_time = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def delay(self, attempt):
+        """Seconds to wait before retry `attempt` (0 based)"""
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
@@ -0,0 +1,189 @@
+"""
+Streaming of huge multi-bulk replies (LRANGE, SMEMBERS, HGETALL, ...):
+elements are handed over in chunks as they get parsed, the whole reply is
+never built as a list.
+"""
+import sys
+import asyncio
+import collections
+
+from redis._compat import nativestr
+from redis.exceptions import ConnectionError, InvalidResponse
+
+from redis_batch.parser import AsyncReaderParser, PythonReader
+
+__all__ = ['ReplyStream']
+
+
+class ReplyStream:
+    """
+    Elements of the multi-bulk reply to `args` executed on a connection of
+    its own, released once all the elements are read (or on `close`):
+
+    >>> with ReplyStream(pipe, ('LRANGE', 'key', 0, -1)) as stream:
+    ...     chunk = yield from stream.next_chunk()  # [] once done
+    >>> async with stream:  # python 3.5+
+    ...     async for element in stream:
+    ...         pass
+
+    A stream left before its end (`break`, error in the loop body, ...)
+    holds a connection with replies left unread, the `with` block (or
+    `close`) gives it back to the pool disconnected.
+
+    Elements are raw replies (no response callbacks), the socket is only
+    read once the parsed elements got consumed. `AsyncProtocolConnection`
+    parses the whole reply first, elements are then chunked as usual.
+
+    Reads are limited to the connection `socket_timeout` (raising
+    `ConnectionError`), each `next_chunk` to `timeout` seconds (raising
+    `asyncio.TimeoutError`), the connection is then disconnected.
+    """
+    read_size = 65536
+
+    def __init__(self, pipe, args, chunk_size=1000, timeout=None):
+        self.pipe = pipe
+        self.args = args
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.remaining = None  # elements not parsed yet, None before start
+        self.connection = None
+        self._reader = None
+        self._parsed = collections.deque()  # fully parsed replies
+        self._chunk = collections.deque()  # iterated over by `__anext__`
+
+    @asyncio.coroutine
+    def start(self):
+        """Send the command, read the multi-bulk header"""
+        self.connection = yield from self.pipe.acquire_connection()
+        try:
+            connection = self.connection
+            yield from connection.send_packed_command(
+                connection.pack_command(*self.args))
+            if connection.get_reader() is None:
+                reply = yield from connection.read_response()
+                self._parsed.extend(reply or ())
+                self.remaining = 0
+            else:
+                self.remaining = yield from self._read_header()
+                self._reader = self._make_reader()
+        except:
+            self.close()
+            self.remaining = 0
+            raise
+
+    def _make_reader(self):
+        encoding = None
+        if self.connection.decode_responses:
+            encoding = self.connection.encoding
+        parser = self.connection._parser
+        if isinstance(parser, AsyncReaderParser):
+            return parser.make_reader(encoding)
+        return PythonReader(encoding=encoding)
+
+    @asyncio.coroutine
+    def _read(self, read):
+        """`read` from the connection reader, within `socket_timeout`"""
+        try:
+            return (yield from self.connection.with_timeout(read))
+        except asyncio.TimeoutError:
+            raise ConnectionError("Timeout reading from socket")
+
+    @asyncio.coroutine
+    def _read_header(self):
+        line = yield from self._read(self.connection.get_reader().readline())
+        if not line:
+            raise ConnectionError("Socket closed on remote end")
+        byte, line = line[:1], line[1:-2]
+        if byte == b'-':
+            self.remaining = 0  # the connection can be reused
+            raise self.connection._parser.parse_error(nativestr(line))
+        if byte == b'$' and line == b'-1':
+            return 0  # nil reply: no elements
+        if byte != b'*':
+            raise InvalidResponse("Not a multi-bulk reply: %r" % (byte + line))
+        return max(int(line), 0)
+
+    @asyncio.coroutine
+    def next_chunk(self):
+        """Next list of up to `chunk_size` elements, [] once all were read"""
+        if self.timeout is None:
+            return (yield from self._next_chunk())
+        try:
+            return (yield from asyncio.wait_for(
+                self._next_chunk(), self.timeout,
+                loop=self.pipe._loop))
+        except asyncio.TimeoutError:
+            self.close()
+            raise
+
+    @asyncio.coroutine
+    def _next_chunk(self):
+        if self.remaining is None:
+            yield from self.start()
+        chunk = []
+        while self._parsed and len(chunk) < self.chunk_size:
+            chunk.append(self._parsed.popleft())
+        try:
+            while self.remaining and len(chunk) < self.chunk_size:
+                element = self._reader.gets()
+                if element is not False:
+                    chunk.append(element)
+                    self.remaining -= 1
+                    continue
+                if chunk:
+                    break  # hand over the parsed ones before reading more
+                data = yield from self._read(
+                    self.connection.get_reader().read(self.read_size))
+                if not data:
+                    raise ConnectionError("Socket closed on remote end")
+                self._reader.feed(data)
+        except asyncio.CancelledError:
+            self.close()
+            raise
+        except Exception:
+            e = sys.exc_info()[1]
+            self.close()
+            if isinstance(e, ConnectionError):
+                raise
+            raise ConnectionError("Error while reading from socket: %s" %
+                                  (e.args,))
+        if not self.remaining and not self._parsed:
+            self.close()
+        return chunk
+
+    def close(self):
+        """
+        Release the connection, disconnected unless the reply was read whole
+        """
+        connection, self.connection = self.connection, None
+        self._reader = None
+        if connection is None:
+            return
+        if self.remaining != 0:
+            connection.disconnect()
+        self.pipe.connection_pool.release(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._chunk:
+            self._chunk.extend((yield from self.next_chunk()))
+            if not self._chunk:
+                raise StopAsyncIteration
+        return self._chunk.popleft()
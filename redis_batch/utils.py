@@ -1,34 +1,98 @@
-import time
 import asyncio
+import collections
 
 
-class DelayedTask(asyncio.Task):
-    """loop.call_later but for Tasks"""
-    def __init__(self, delay, coro, *, loop=None):
-        assert asyncio.iscoroutine(coro), repr(coro)
-        asyncio.Future.__init__(self, loop=loop)
-        self._coro = iter(coro)
-        self._fut_waiter = None
-        self._must_cancel = False
-        self._loop.call_later(delay, self._step)
-        self.__class__._all_tasks.add(self)
-
-
-class DrainQueueBase(asyncio.Queue):
+class DrainQueueBase:
     """
     Base class for all sort DrainQueues with `drain` Task scheduling:
 
     Examples:
     - SizeDrainQueue - drain after queue gets full
     - TimeSizeDrainQueue - drain when oldest element > timeout or queue full
+    - IdleDrainQueue - drain at the end of the loop iteration or queue full
+
+    Items are kept in a plain list swapped out on flush. Only the parts of
+    the `asyncio.Queue` interface drains rely on are provided (no getters
+    waiting for items, no `join`).
     """
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+    def __init__(self, maxsize=0, *, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._maxsize = maxsize
+        self._queue = []
+        self._putters = collections.deque()
         self.drain_tasks = set()
         self.active_drain_tasks = set()
 
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def qsize(self):
+        return len(self._queue)
+
+    def empty(self):
+        return not self._queue
+
+    def full(self):
+        if self._maxsize <= 0:
+            return False
+        return len(self._queue) >= self._maxsize
+
+    def _put(self, item):
+        self._queue.append(item)
+
+    def put_nowait(self, item):
+        if self.full():
+            raise asyncio.QueueFull
+        self._put(item)
+
+    @asyncio.coroutine
+    def put(self, item):
+        """Put `item` waiting for a drain while the queue is full"""
+        while self.full():
+            putter = asyncio.Future(loop=self._loop)
+            self._putters.append(putter)
+            yield from putter
+        self._put(item)
+
+    def push(self, item):
+        """
+        Synchronous `put`: never waits for a drain nor raises `QueueFull`,
+        instead the queue goes over `maxsize` until the next drains flush
+        it in `maxsize` batches.
+        """
+        self._put(item)
+
+    def get_nowait(self):
+        if not self._queue:
+            raise asyncio.QueueEmpty
+        item = self._queue.pop(0)
+        self._wakeup_putters()
+        return item
+
+    def _wakeup_putters(self):
+        """putters re-check `full` once resumed"""
+        while self._putters and not self.full():
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+
+    def _batch_size(self):
+        """number of items to flush, at most `maxsize` (when set)"""
+        if self.maxsize > 0:
+            return min(self.qsize(), self.maxsize)
+        return self.qsize()
+
     def _flush(self):
-        return [self.get_nowait() for n in range(self.qsize())]
+        q, n = self._queue, self._batch_size()
+        if n == len(q):
+            self._queue = []
+        else:
+            q, self._queue = q[:n], q[n:]
+        self._wakeup_putters()
+        return q
 
     @asyncio.coroutine
     def _drain(self, event_type, **kwargs):
@@ -48,9 +112,13 @@ class DrainQueueBase(asyncio.Queue):
 
         # use q to enable puts and enable multiple drain tasks
         q = self._flush()
-        yield from self.drain(q)
-        self.drain_tasks.remove(current)
-        self.active_drain_tasks.remove(current)
+        started = self._loop.time()
+        try:
+            yield from self.drain(q)
+        finally:
+            self.drain_done(q, self._loop.time() - started)
+            self.drain_tasks.remove(current)
+            self.active_drain_tasks.remove(current)
 
     @asyncio.coroutine
     def drain(self, q):
@@ -65,6 +133,12 @@ class DrainQueueBase(asyncio.Queue):
         """
         return False
 
+    def drain_done(self, q, elapsed):
+        """
+        Called after `drain(q)` returned, `elapsed` is the time (in seconds)
+        the drain took. Does nothing by default.
+        """
+
 
 class SizeDrainQueue(DrainQueueBase):
     """
@@ -77,12 +151,12 @@ class SizeDrainQueue(DrainQueueBase):
 
     def _put(self, item):
         self._queue.append(item)
-        if self.full():
+        if self.qsize() == self.maxsize:
             self.drain_tasks.add(
                 asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
 
     def _flush(self):
-        q = [self.get_nowait() for n in range(self.qsize())]
+        q = super()._flush()
         if self.full():
             self.drain_tasks.add(
                 asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
@@ -110,30 +184,55 @@ class TimeSizeDrainQueue(DrainQueueBase):
         super().__init__(*args, **kwargs)
         self.timeout = timeout
         self.timestamp = None
+        self._timer = None
+        self._timer_when = None
+
+    def _arm_timer(self):
+        """
+        Make sure the queue timer fires by `timestamp + timeout`.
+
+        There is at most one timer per queue. An armed timer firing early
+        (e.g. the batch it was armed for got size drained) re-arms itself
+        for the current deadline rather than being cancelled here.
+        """
+        when = self.timestamp + self.timeout
+        if self._timer is not None:
+            if self._timer_when <= when:
+                return
+            self._timer.cancel()
+        self._timer_when = when
+        self._timer = self._loop.call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        if self.empty():
+            return
+        # timers may fire a clock resolution early, so the deadline is
+        # compared with the time the timer was armed for, not with `time()`
+        # (re-arming for a past deadline would spin the loop)
+        if self.timestamp + self.timeout > self._timer_when:
+            self._arm_timer()  # armed for an earlier batch
+            return
+        self.drain_tasks.add(asyncio.Task(self._drain(
+            self.ET_TDRAIN, timestamp=self.timestamp), loop=self._loop))
 
     def _put(self, item):
         if self.empty():
-            self.timestamp = time.time()
-            self.drain_tasks.add(
-                DelayedTask(self.timeout, self._drain(
-                    self.ET_TDRAIN, timestamp=self.timestamp),
-                    loop=self._loop))
+            self.timestamp = self._loop.time()
+            self._arm_timer()
         self._queue.append(item)
-        if self.full():
+        if self.qsize() == self.maxsize:
             self.drain_tasks.add(
                 asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
 
     def _flush(self):
-        q = [self.get_nowait() for n in range(self.qsize())]
+        q = super()._flush()
         if self.full():
             self.drain_tasks.add(
                 asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
         elif not self.empty():
-            self.timestamp = time.time()
-            self.drain_tasks.add(
-                DelayedTask(self.timeout, self._drain(
-                    self.ET_TDRAIN, timestamp=self.timestamp),
-                    loop=self._loop))
+            self.timestamp = self._loop.time()
+            self._arm_timer()
         return q
 
     @asyncio.coroutine
@@ -149,7 +248,262 @@ class TimeSizeDrainQueue(DrainQueueBase):
         raise ValueError('unknown event_type: {}'.format(event_type))
 
 
+class IdleDrainQueue(DrainQueueBase):
+    """
+    Schedules a `drain` queue Task when:
+    - the loop ran the callbacks ready when the first element got queued,
+      so everything queued during that loop iteration is drained together
+    - the queue gets full `qsize` >= `maxsize`.
+    """
+    ET_SDRAIN = 1  # size drain
+    ET_IDRAIN = 3  # idle drain
+    timeout = 0  # no batching window
+
+    def __init__(self, *args, **kwargs):
+        """maxsize param is optional"""
+        super().__init__(*args, **kwargs)
+        self._idle_handle = None
+
+    def _schedule_idle(self):
+        if self._idle_handle is None:
+            self._idle_handle = self._loop.call_soon(self._on_idle)
+
+    def _on_idle(self):
+        self._idle_handle = None
+        if self.empty():
+            return
+        self.drain_tasks.add(
+            asyncio.Task(self._drain(self.ET_IDRAIN), loop=self._loop))
+
+    def _put(self, item):
+        if self.empty():
+            self._schedule_idle()
+        self._queue.append(item)
+        if self.qsize() == self.maxsize:
+            self.drain_tasks.add(
+                asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
+
+    def _flush(self):
+        q = super()._flush()
+        if self.full():
+            self.drain_tasks.add(
+                asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
+        elif not self.empty():
+            self._schedule_idle()
+        return q
+
+    @asyncio.coroutine
+    def drain(self, q):
+        pass
+
+    def cancel_drain(self, event_type, **kwargs):
+        if event_type == self.ET_SDRAIN:
+            return not self.full()
+        elif event_type == self.ET_IDRAIN:
+            return self.empty()
+
+        raise ValueError('unknown event_type: {}'.format(event_type))
+
+
+class AdaptiveTimeSizeDrainQueue(TimeSizeDrainQueue):
+    """
+    TimeSizeDrainQueue resizing its `timeout` and `maxsize` at runtime,
+    within `timeout_range` and `maxsize_range`, from the measured arrival
+    rate (puts per second) and round-trip time (`drain` duration):
+
+    - light load: the window shrinks to the lower bound as waiting would
+      not collect anything to batch
+    - heavy load: the batch grows to what arrives during one round-trip
+      and the window to the round-trip time
+
+    Current values are exposed as `timeout`, `maxsize`, `arrival_rate`
+    and `rtt`.
+    """
+    def __init__(self, timeout, maxsize, *args,
+                 timeout_range=(0.0005, 0.05), maxsize_range=(10, 5000),
+                 smoothing=0.2, **kwargs):
+        super().__init__(timeout, *args, maxsize=maxsize, **kwargs)
+        self.timeout_range = timeout_range
+        self.maxsize_range = maxsize_range
+        self.smoothing = smoothing
+        self.arrival_rate = None
+        self.rtt = None
+        self._arrivals = 0
+        self._arrivals_since = self._loop.time()
+
+    def _put(self, item):
+        self._arrivals += 1
+        super()._put(item)
+
+    def _ewma(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def drain_done(self, q, elapsed):
+        now = self._loop.time()
+        period = now - self._arrivals_since
+        if period > 0:
+            self.arrival_rate = self._ewma(
+                self.arrival_rate, self._arrivals / period)
+            self._arrivals = 0
+            self._arrivals_since = now
+        self.rtt = self._ewma(self.rtt, elapsed)
+        self._adapt()
+
+    def _adapt(self):
+        if not self.arrival_rate or self.rtt is None:
+            return
+        min_timeout, max_timeout = self.timeout_range
+        min_maxsize, max_maxsize = self.maxsize_range
+
+        # keep room for what arrives while the previous batch is in flight
+        expected = self.arrival_rate * self.rtt
+        self._maxsize = max(min_maxsize, min(max_maxsize, int(2 * expected)))
+
+        if self.arrival_rate * max_timeout < 2:
+            # nothing to batch with, do not delay the lonely command
+            self.timeout = min_timeout
+        else:
+            fill_time = self._maxsize / self.arrival_rate
+            self.timeout = max(
+                min_timeout, min(max_timeout, self.rtt, fill_time))
+        if not self.empty():
+            self._arm_timer()  # the window may have shrunk
+        self._wakeup_putters()  # or maxsize grown
+
+        if self.full():
+            self.drain_tasks.add(
+                asyncio.Task(self._drain(self.ET_SDRAIN), loop=self._loop))
+
+
 class PipeCommandQueue(TimeSizeDrainQueue):
     @asyncio.coroutine
     def drain(self, q):
-        yield from self.pipe.execute_stack(q)
+        # errors are delivered to the command futures
+        yield from self.pipe.execute_stack(q, raise_on_error=False)
+
+
+class AdaptivePipeCommandQueue(AdaptiveTimeSizeDrainQueue):
+    drain = PipeCommandQueue.drain
+
+
+class IdlePipeCommandQueue(IdleDrainQueue):
+    drain = PipeCommandQueue.drain
+
+
+class PipeLane(PipeCommandQueue):
+    """
+    `PipeCommandQueue` lane of a `PipeLaneQueue`, timed by the timer the
+    lanes share
+    """
+    def __init__(self, lanes, timeout, maxsize=0, *, loop=None):
+        super().__init__(timeout, maxsize=maxsize, loop=loop)
+        self.lanes = lanes
+
+    @property
+    def deadline(self):
+        """when the oldest queued command is due"""
+        return self.timestamp + self.timeout
+
+    def _arm_timer(self):
+        self.lanes.arm_timer(self.deadline)
+
+
+class PipeLaneQueue:
+    """
+    Command queue made of named lanes, `PipeLane`s with their own `timeout`
+    and `maxsize`, e.g. `{'immediate': (0, 100), 'bulk': (0.05, 5000)}`.
+    A command goes to the lane of its `lane` option, else the one of its
+    command name in `commands`, else to `default`.
+
+    A single timer serves all the lanes: due lanes are flushed nearest
+    deadline (oldest command timestamp + lane timeout) first. Commands of
+    different lanes are not executed in the order they were queued.
+    """
+    def __init__(self, lanes, default, commands=None, *, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self.lanes = {name: PipeLane(self, timeout, maxsize, loop=loop)
+                      for name, (timeout, maxsize) in lanes.items()}
+        if default not in self.lanes:
+            raise ValueError('unknown default lane: {}'.format(default))
+        self.default = default
+        self.commands = {name.upper(): lane
+                         for name, lane in (commands or {}).items()}
+        unknown = set(self.commands.values()) - set(self.lanes)
+        if unknown:
+            raise ValueError('unknown lanes: {}'.format(sorted(unknown)))
+        self._pipe = None
+        self._timer = None
+        self._timer_when = None
+
+    @property
+    def pipe(self):
+        return self._pipe
+
+    @pipe.setter
+    def pipe(self, pipe):
+        self._pipe = pipe
+        for lane in self.lanes.values():
+            lane.pipe = pipe
+
+    @property
+    def timeout(self):
+        """`timeout` of the default lane"""
+        return self.lanes[self.default].timeout
+
+    @property
+    def maxsize(self):
+        """`maxsize` of the default lane"""
+        return self.lanes[self.default].maxsize
+
+    def qsize(self):
+        return sum(lane.qsize() for lane in self.lanes.values())
+
+    def empty(self):
+        return all(lane.empty() for lane in self.lanes.values())
+
+    def lane(self, item):
+        """lane of the `(fut, args, options)` command record `item`"""
+        fut, args, options = item
+        name = options.get('lane')
+        if name is None:
+            command = args[0]
+            if isinstance(command, bytes):
+                command = command.decode()
+            name = self.commands.get(command.upper(), self.default)
+        return self.lanes[name]
+
+    @asyncio.coroutine
+    def put(self, item):
+        yield from self.lane(item).put(item)
+
+    def push(self, item):
+        self.lane(item).push(item)
+
+    def arm_timer(self, when):
+        """Make sure the shared timer fires by `when`"""
+        if self._timer is not None:
+            if self._timer_when <= when:
+                return
+            self._timer.cancel()
+        self._timer_when = when
+        self._timer = self._loop.call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        # the timer may fire a clock resolution early (see
+        # `TimeSizeDrainQueue._on_timer`)
+        due = max(self._loop.time(), self._timer_when)
+        pending = sorted((lane for lane in self.lanes.values()
+                          if not lane.empty()),
+                         key=lambda lane: lane.deadline)
+        for lane in pending:
+            if lane.deadline > due:
+                self.arm_timer(lane.deadline)
+                break
+            # drains start in the order their tasks are created
+            lane.drain_tasks.add(asyncio.Task(lane._drain(
+                lane.ET_TDRAIN, timestamp=lane.timestamp), loop=self._loop))
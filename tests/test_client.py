@@ -0,0 +1,123 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from redis_batch.client import BatchStrictRedisClient
+from redis_batch.connection import (
+    AsyncConnection, AsyncUnixDomainSocketConnection,
+    AsyncUnixDomainSocketProtocolConnection)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class ClientTestBase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class TestConnectionClass(ClientTestBase):
+    def test_tcp(self):
+        pool = BatchStrictRedisClient(self.loop, port=6380).connection_pool
+        self.assertIs(pool.connection_class, AsyncConnection)
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+
+    def test_unix_socket_path(self):
+        pool = BatchStrictRedisClient(
+            self.loop, unix_socket_path='/tmp/redis.sock').connection_pool
+        self.assertIs(pool.connection_class, AsyncUnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis.sock')
+        self.assertNotIn('host', pool.connection_kwargs)
+        connection = pool.make_connection()
+        self.assertEqual(connection.path, '/tmp/redis.sock')
+
+    def test_unix_socket_protocol_connection(self):
+        client = BatchStrictRedisClient(
+            self.loop, unix_socket_path='/tmp/redis.sock',
+            connection_class=AsyncUnixDomainSocketProtocolConnection)
+        self.assertIs(client.connection_pool.connection_class,
+                      AsyncUnixDomainSocketProtocolConnection)
+
+    def test_unix_socket_path_unsupported(self):
+        self.assertRaises(ValueError, BatchStrictRedisClient, self.loop,
+                          unix_socket_path='/tmp/redis.sock',
+                          connection_class=AsyncConnection)
+
+
+class TestCallTimeout(ClientTestBase):
+    def setUp(self):
+        super().setUp()
+        self.client = BatchStrictRedisClient(self.loop, cmd_call_timeout=0.01)
+        self.client._pipe.push_command = unittest.mock.Mock()
+        self.handles = []
+        self.delays = []
+
+        def call_later(delay, callback, *args):
+            self.delays.append(delay)
+            self.handles.append(self.loop.call_at(
+                self.loop.time() + delay, callback, *args))
+            return self.handles[-1]
+
+        patcher = unittest.mock.patch.object(
+            self.loop, 'call_later', side_effect=call_later)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_default_timeout(self):
+        fut = self.client.execute_command('GET', 'k')
+        self.assertEqual(self.delays, [0.01])
+        self.assertRaises(asyncio.TimeoutError,
+                          self.loop.run_until_complete, fut)
+        self.assertEqual(self.client._pipe.stats['timeouts'], 1)
+
+    def test_timeout_option(self):
+        fut = self.client.execute_command('GET', 'k', timeout=0.001)
+        self.assertEqual(self.delays, [0.001])
+        self.assertRaises(asyncio.TimeoutError,
+                          self.loop.run_until_complete, fut)
+        self.assertEqual(self.client._pipe.stats['timeouts'], 1)
+
+    def test_no_timeout(self):
+        self.client.execute_command('GET', 'k', timeout=None)
+        self.assertEqual(self.delays, [])
+
+    def test_resolved_in_time(self):
+        fut = self.client.execute_command('GET', 'k')
+        fut.set_result(b'v')
+        self.loop.run_until_complete(asyncio.sleep(0.02, loop=self.loop))
+        self.assertTrue(self.handles[0]._cancelled)
+        self.assertEqual(fut.result(), b'v')
+        self.assertEqual(self.client._pipe.stats['timeouts'], 0)
+
+
+class TestExecuteAtomic(ClientTestBase):
+    def setUp(self):
+        super().setUp()
+        self.client = BatchStrictRedisClient(self.loop, cmd_mode='auto')
+        self.client._pipe.push_group = unittest.mock.Mock()
+
+    def test_replies(self):
+        fut = self.client.execute_atomic(('INCR', 'h'), ('EXPIRE', 'h', 60))
+        (record_fut, group, options), kwargs = (
+            self.client._pipe.push_group.call_args)
+        self.assertIs(record_fut, fut)
+        self.assertEqual([args for f, args in group],
+                         [('INCR', 'h'), ('EXPIRE', 'h', 60)])
+        group[0][0].set_result(1)
+        group[1][0].set_result(True)
+        self.assertEqual(self.loop.run_until_complete(fut), [1, True])
+
+    def test_timeout(self):
+        fut = self.client.execute_atomic(('INCR', 'h'), ('INCR', 'i'),
+                                         timeout=0.001)
+        self.assertRaises(asyncio.TimeoutError,
+                          self.loop.run_until_complete, fut)
+        self.assertEqual(self.client._pipe.stats['timeouts'], 2)
+
+    def test_pipeline_mode(self):
+        client = BatchStrictRedisClient(self.loop, cmd_mode='pipeline')
+        self.assertRaises(ValueError, client.execute_atomic, ('INCR', 'h'))
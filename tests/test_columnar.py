@@ -0,0 +1,61 @@
+import array
+import unittest
+import unittest.mock
+
+from redis.exceptions import RedisError
+
+from redis_batch import columnar
+from redis_batch.columnar import column, scored_columns, NUMPY_AVAILABLE
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+TYPECODES = {'int64': 'q', 'float64': 'd'}
+
+
+class TestColumnArray(unittest.TestCase):
+    use_numpy = False
+
+    def assertColumn(self, col, values, dtype):
+        if self.use_numpy:
+            self.assertEqual(col.dtype.name, dtype)
+        else:
+            self.assertIsInstance(col, array.array)
+            self.assertEqual(col.typecode, TYPECODES[dtype])
+        self.assertEqual(list(col), values)
+
+    def test_int64(self):
+        col = column([b'1', b'-20', b'300'], 'int64', use_numpy=self.use_numpy)
+        self.assertColumn(col, [1, -20, 300], 'int64')
+
+    def test_float64(self):
+        col = column([b'1.5', b'-inf', '2'], 'float64',
+                     use_numpy=self.use_numpy)
+        self.assertColumn(col, [1.5, float('-inf'), 2.0], 'float64')
+
+    def test_missing(self):
+        col = column([b'1', None, b'3'], 'int64', missing=-1,
+                     use_numpy=self.use_numpy)
+        self.assertColumn(col, [1, -1, 3], 'int64')
+
+    def test_empty(self):
+        self.assertColumn(column([], 'int64', use_numpy=self.use_numpy),
+                          [], 'int64')
+
+    def test_scored_columns(self):
+        members, scores = scored_columns(
+            [b'a', b'1', b'b', b'2.5'], use_numpy=self.use_numpy)
+        self.assertEqual(members, [b'a', b'b'])
+        self.assertColumn(scores, [1.0, 2.5], 'float64')
+
+    def test_numpy_missing(self):
+        with unittest.mock.patch.object(columnar, 'NUMPY_AVAILABLE', False):
+            self.assertRaises(RedisError, column, [b'1'], use_numpy=True)
+            self.assertIsInstance(column([b'1']), array.array)
+
+
+@unittest.skipUnless(NUMPY_AVAILABLE, "NumPy is not installed")
+class TestColumnNumpy(TestColumnArray):
+    use_numpy = True
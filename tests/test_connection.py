@@ -0,0 +1,391 @@
+import io
+import gc
+import asyncio
+import unittest
+import unittest.mock
+
+from redis.connection import Connection
+from redis.exceptions import (
+    ConnectionError, DataError, InvalidResponse, ResponseError)
+
+from redis_batch.connection import (
+    AsyncConnection, AsyncConnectionPool, AsyncProtocolConnection,
+    RedisProtocol, ReplyTurn)
+from redis_batch.packer import CommandPacker, BUFFER_CUTOFF
+from redis_batch.parser import AsyncBufferedPythonParser, PythonReader
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class TestReadBulkInto(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connection = AsyncConnection(loop=self.loop)
+        self.connection._reader = asyncio.StreamReader(loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read_bulk_into(self, data, target=None):
+        self.connection._reader.feed_data(data)
+        return self.loop.run_until_complete(
+            self.connection.read_bulk_into(target))
+
+    def test_new_buffer(self):
+        value = self.read_bulk_into(b'$5\r\nhello\r\n+OK\r\n')
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value, b'hello')
+        self.assertEqual(self.loop.run_until_complete(
+            self.connection._reader.read(5)), b'+OK\r\n')
+
+    def test_bytearray(self):
+        target = bytearray(10)
+        value = self.read_bulk_into(b'$5\r\nhello\r\n', target)
+        self.assertEqual(value, b'hello')
+        self.assertEqual(target, b'hello\x00\x00\x00\x00\x00')
+
+        value = self.read_bulk_into(b'$2\r\nhi\r\n', memoryview(target)[5:])
+        self.assertEqual(value, b'hi')
+        self.assertEqual(target, b'hellohi\x00\x00\x00')
+
+    def test_file(self):
+        target = io.BytesIO()
+        self.assertEqual(self.read_bulk_into(b'$5\r\nhello\r\n', target), 5)
+        self.assertEqual(target.getvalue(), b'hello')
+
+    def test_nil(self):
+        self.assertIsNone(self.read_bulk_into(b'$-1\r\n'))
+
+    def test_error(self):
+        self.assertRaises(ResponseError, self.read_bulk_into,
+                          b'-WRONGTYPE Operation against a key\r\n')
+
+    def test_too_small(self):
+        self.assertRaises(DataError, self.read_bulk_into,
+                          b'$5\r\nhello\r\n', bytearray(4))
+        self.assertIsNone(self.connection._reader)
+
+
+class TestSocketTimeout(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connection = AsyncConnection(
+            loop=self.loop, socket_timeout=0.05,
+            parser_class=AsyncBufferedPythonParser)
+        self.connection._reader = asyncio.StreamReader(loop=self.loop)
+        self.connection._writer = unittest.mock.Mock()
+        self.connection.on_connect = unittest.mock.Mock()
+        self.connection._parser.on_connect(self.connection)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read_responses(self, n):
+        return self.loop.run_until_complete(
+            self.connection.read_responses(n))
+
+    def test_in_time(self):
+        self.connection._reader.feed_data(b'+OK\r\n:1\r\n')
+        self.assertEqual(self.read_responses(2), [b'OK', 1])
+
+    def test_read_timeout(self):
+        self.connection._reader.feed_data(b'+OK\r\n')
+        self.assertRaises(ConnectionError, self.read_responses, 2)
+        self.assertIsNone(self.connection._writer)
+
+    def test_read_timeout_nothing_logged(self):
+        errors = []
+        self.loop.set_exception_handler(
+            lambda loop, context: errors.append(context))
+        self.assertRaises(ConnectionError, self.read_responses, 1)
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        gc.collect()
+        self.assertEqual(errors, [])
+
+    def test_read_bulk_timeout(self):
+        self.connection._reader.feed_data(b'$5\r\nhe')
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          self.connection.read_bulk_into())
+        self.assertIsNone(self.connection._writer)
+
+
+class TestReplyTurn(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connection = AsyncConnection(loop=self.loop)
+        self.connection._writer = unittest.mock.Mock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    @asyncio.coroutine
+    def read_batch(self, turn, error=None):
+        with turn:
+            yield from turn.wait()
+            if error is not None:
+                raise error
+            turn.release()
+
+    def test_first_batch_fails(self):
+        first = ReplyTurn(self.connection)
+        second = ReplyTurn(self.connection, first.future)
+        self.assertRaises(
+            ConnectionError, self.loop.run_until_complete,
+            self.read_batch(first, ConnectionError('lost')))
+        self.assertEqual(self.connection.generation, 1)
+
+        # reconnected for a newer batch meanwhile
+        writer = self.connection._writer = unittest.mock.Mock()
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          self.read_batch(second))
+        self.assertIs(self.connection._writer, writer)
+        self.assertEqual(self.connection.generation, 1)
+
+
+def mock_connection(**kwargs):
+    connection = unittest.mock.Mock()
+    connection.connect = asyncio.coroutine(connection.opened)
+    return connection
+
+
+class TestAsyncConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pool = AsyncConnectionPool(
+            connection_class=unittest.mock.Mock, max_connections=1,
+            loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def at(self, now):
+        """`loop.time` patched to return `now`"""
+        return unittest.mock.patch.object(self.loop, 'time',
+                                          return_value=now)
+
+    def idle_pool(self, n, **kwargs):
+        """pool with `n` connections released at times 0, 1, ..."""
+        pool = AsyncConnectionPool(connection_class=mock_connection,
+                                   loop=self.loop, **kwargs)
+        connections = [pool.get_connection('GET') for i in range(n)]
+        for i, connection in enumerate(connections):
+            with self.at(i):
+                pool.release(connection)
+        return pool, connections
+
+    def test_reap(self):
+        pool, connections = self.idle_pool(3, idle_timeout=10)
+        with self.at(11.5):
+            pool._reap()
+        self.assertEqual([c.disconnect.call_count for c in connections],
+                         [1, 1, 0])
+        self.assertEqual(pool._created_connections, 1)
+        self.assertEqual(pool._reaper._when, 12)  # the next one is due
+        pool._reaper.cancel()
+
+    def test_reap_min_idle(self):
+        pool, connections = self.idle_pool(3, idle_timeout=10, min_idle=2)
+        with self.at(100):
+            pool._reap()
+        self.assertEqual([c.disconnect.call_count for c in connections],
+                         [1, 0, 0])
+        self.assertIsNone(pool._reaper)
+        # the most recently released ones are kept
+        self.assertEqual([c for c, idle_since in pool._idle],
+                         connections[1:])
+
+    def test_health_check(self):
+        pool, connections = self.idle_pool(1, health_check_interval=30)
+        with self.at(30):
+            connection = pool.get_connection('GET')
+        self.assertTrue(connection.needs_health_check)
+        with self.at(31):
+            pool.release(connection)
+        with self.at(60):
+            self.assertFalse(pool.get_connection('GET').needs_health_check)
+
+    def test_warmup(self):
+        pool = AsyncConnectionPool(connection_class=mock_connection,
+                                   min_idle=2, loop=self.loop)
+        self.loop.run_until_complete(pool.warmup())
+        connections = [c for c, idle_since in pool._idle]
+        self.assertEqual(len(connections), 2)
+        for connection in connections:
+            self.assertEqual(connection.opened.call_count, 1)
+        self.loop.run_until_complete(pool.warmup())
+        self.assertEqual(pool._created_connections, 2)
+        self.assertIn(self.loop.run_until_complete(pool.acquire()),
+                      connections)
+
+    def test_warmup_failed(self):
+        def connection_class(**kwargs):
+            connection = unittest.mock.Mock()
+            connection.connect = asyncio.coroutine(unittest.mock.Mock(
+                side_effect=ConnectionError('refused')))
+            return connection
+
+        pool = AsyncConnectionPool(connection_class=connection_class,
+                                   min_idle=2, loop=self.loop)
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          pool.warmup())
+        self.assertEqual(pool._created_connections, 0)
+        self.assertEqual(len(pool._idle), 0)
+
+    def test_waiter_cancelled(self):
+        connection = self.loop.run_until_complete(self.pool.acquire())
+        waiting = asyncio.Task(self.pool.acquire(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.pool.release(connection)  # handed over to the waiter
+        waiting.cancel()
+        self.assertRaises(asyncio.CancelledError,
+                          self.loop.run_until_complete, waiting)
+        self.assertEqual(self.loop.run_until_complete(
+            self.pool.acquire(timeout=0.01)), connection)
+
+
+class TestRedisProtocol(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.protocol = RedisProtocol(
+            PythonReader(protocolError=InvalidResponse,
+                         replyError=ResponseError), loop=self.loop)
+        self.transport = unittest.mock.Mock()
+        self.protocol.connection_made(self.transport)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read_replies(self, n, on_reply=None):
+        """Start waiting for `n` replies, returns the Task"""
+        task = asyncio.Task(self.protocol.read_replies(n, on_reply),
+                            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        return task
+
+    def test_split_batch(self):
+        on_reply = unittest.mock.Mock()
+        task = self.read_replies(3, on_reply)
+        self.protocol.data_received(b'+OK\r\n:1')
+        on_reply.assert_called_once_with(0, b'OK')
+        self.protocol.data_received(b'\r\n$3\r\nab')
+        self.assertEqual(on_reply.call_count, 2)
+        self.assertFalse(task.done())
+        self.protocol.data_received(b'c\r\n')
+        self.assertEqual(self.loop.run_until_complete(task),
+                         [b'OK', 1, b'abc'])
+        self.assertIsNone(self.protocol._batch)
+
+    def test_replies_before_wait(self):
+        self.protocol.data_received(b'+OK\r\n-ERR wrong\r\n:1\r\n')
+        replies = self.loop.run_until_complete(
+            self.protocol.read_replies(2))
+        self.assertEqual(replies[0], b'OK')
+        self.assertIsInstance(replies[1], ResponseError)
+        task = self.read_replies(2)
+        self.assertFalse(task.done())
+        self.protocol.data_received(b':2\r\n')
+        self.assertEqual(self.loop.run_until_complete(task), [1, 2])
+
+    def test_connection_lost(self):
+        task = self.read_replies(2)
+        self.protocol.data_received(b'+OK\r\n')
+        self.protocol.connection_lost(None)
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          task)
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          self.protocol.read_replies(1))
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          self.protocol.drain())
+
+    def test_protocol_error(self):
+        task = self.read_replies(1)
+        self.protocol.data_received(b'?\r\n')
+        self.assertRaises(InvalidResponse, self.loop.run_until_complete,
+                          task)
+        self.transport.close.assert_called_once_with()
+
+    def test_drain(self):
+        self.loop.run_until_complete(self.protocol.drain())
+        self.protocol.pause_writing()
+        drain = asyncio.Task(self.protocol.drain(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertFalse(drain.done())
+        self.protocol.resume_writing()
+        self.loop.run_until_complete(drain)
+
+
+class TestInitSession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_auth_select(self):
+        connection = AsyncConnection(
+            loop=self.loop, password='secret', db=2,
+            parser_class=AsyncBufferedPythonParser)
+        connection._reader = asyncio.StreamReader(loop=self.loop)
+        connection._writer = unittest.mock.Mock(
+            drain=asyncio.coroutine(unittest.mock.Mock()))
+        connection._reader.feed_data(b'+OK\r\n+OK\r\n')
+        self.loop.run_until_complete(connection.on_connect())
+        written = b''.join(call[0][0] for call in
+                           connection._writer.write.call_args_list)
+        self.assertEqual(written, b'*2\r\n$4\r\nAUTH\r\n$6\r\nsecret\r\n'
+                                  b'*2\r\n$6\r\nSELECT\r\n$1\r\n2\r\n')
+
+    def test_protocol_connection(self):
+        connection = AsyncProtocolConnection(loop=self.loop, password='x')
+        connection._create_connection = asyncio.coroutine(
+            unittest.mock.Mock(return_value=(
+                unittest.mock.Mock(), unittest.mock.Mock())))
+        init_session = unittest.mock.Mock()
+        connection.init_session = asyncio.coroutine(init_session)
+        self.loop.run_until_complete(connection.connect())
+        self.assertEqual(init_session.call_count, 1)
+
+
+class TestPackCommands(unittest.TestCase):
+    def setUp(self):
+        self.connection = AsyncConnection()
+
+    def assertPacked(self, output, commands):
+        expected = []
+        for args in commands:
+            packed = Connection().pack_command(*args)
+            expected.extend([packed] if isinstance(packed, bytes) else packed)
+        self.assertEqual(b''.join(output), b''.join(expected))
+
+    def test_joined(self):
+        commands = [('GET', 'k%d' % i) for i in range(3)]
+        output = self.connection.pack_commands(commands)
+        self.assertEqual(len(output), 1)
+        self.assertPacked(output, commands)
+
+    def test_joined_up_to_cutoff(self):
+        commands = [('SET', 'k%d' % i, 'v' * 100) for i in range(200)]
+        output = self.connection.pack_commands(commands)
+        self.assertGreater(len(output), 1)
+        for chunk in output:
+            self.assertLess(len(chunk), BUFFER_CUTOFF + 200)
+        self.assertPacked(output, commands)
+
+    def test_large_value_not_joined(self):
+        value = b'v' * (BUFFER_CUTOFF + 1)
+        commands = [('GET', 'a'), ('SET', 'b', value), ('GET', 'c')]
+        output = self.connection.pack_commands(commands)
+        self.assertIn(value, output)
+        self.assertIs(output[output.index(value)], value)
+        self.assertPacked(output, commands)
+
+    def test_prepared(self):
+        hget_users = CommandPacker().prepare('HGET', 'users')
+        ping = b'*1\r\n$4\r\nPING\r\n'
+        output = self.connection.pack_commands(
+            [('GET', 'a'), hget_users.pack('user_id'), ping])
+        self.assertEqual(len(output), 1)
+        self.assertPacked(output, [
+            ('GET', 'a'), ('HGET', 'users', 'user_id'), ('PING', )])
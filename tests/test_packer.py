@@ -0,0 +1,88 @@
+import unittest
+
+from redis.connection import Connection
+from redis_batch.packer import CommandPacker, BUFFER_CUTOFF
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+def packed(chunks):
+    if isinstance(chunks, bytes):
+        return chunks
+    return b''.join(chunks)
+
+
+class TestCommandPacker(unittest.TestCase):
+    def setUp(self):
+        self.packer = CommandPacker()
+        self.connection = Connection()
+
+    def assertPacked(self, *args):
+        self.assertEqual(
+            packed(self.packer.pack_command(*args)),
+            packed(self.connection.pack_command(*args)))
+
+    def test_pack_command(self):
+        self.assertPacked('PING')
+        self.assertPacked('GET', 'key')
+        self.assertPacked('SET', b'key', 'value')
+        self.assertPacked('SET', 'kéy', 1.5)
+        self.assertPacked('INCRBY', 42, 7)
+        self.assertPacked('SET', 'key', 'x' * (BUFFER_CUTOFF + 1))
+
+    def test_multi_word_name(self):
+        expected = packed(self.connection.pack_command(
+            'CONFIG', 'GET', 'maxmemory'))
+        self.assertEqual(
+            packed(self.packer.pack_command('CONFIG GET', 'maxmemory')),
+            expected)
+        self.assertEqual(
+            packed(self.packer.prepare('CONFIG GET').pack('maxmemory')),
+            expected)
+
+    def test_large_value_chunk(self):
+        value = b'x' * (BUFFER_CUTOFF + 1)
+        chunks = self.packer.pack_command('SET', 'key', value)
+        self.assertTrue(any(chunk is value for chunk in chunks))
+
+    def test_cached(self):
+        self.assertPacked('GET', 'key')
+        self.assertPacked('GET', 'key')
+        self.assertPacked('GET', 'other', 'arity')
+        self.assertIn(('GET', 2), self.packer._headers)
+        self.assertIn(('GET', 3), self.packer._headers)
+        self.assertIn('key', self.packer._keys)
+
+    def test_key_cache_bounds(self):
+        packer = CommandPacker(max_cached_keys=2, max_cached_key_size=16)
+        for key in ('a', 'b', 'c', 'x' * 16):
+            packer.pack_command('GET', key)
+        self.assertEqual(list(packer._keys), ['b', 'c'])
+
+        packer.pack_command('GET', 'b')  # most recently used
+        packer.pack_command('GET', 'd')
+        self.assertEqual(list(packer._keys), ['b', 'd'])
+
+
+class TestPreparedCommand(unittest.TestCase):
+    def setUp(self):
+        self.packer = CommandPacker()
+        self.connection = Connection()
+
+    def test_pack(self):
+        hget = self.packer.prepare('HGET', 'users')
+        self.assertEqual(
+            packed(hget.pack('user_id')),
+            packed(self.connection.pack_command('HGET', 'users', 'user_id')))
+
+        hmget = self.packer.prepare('HMGET', 'users')
+        self.assertEqual(
+            packed(hmget.pack(1, 2, 3)),
+            packed(self.connection.pack_command('HMGET', 'users', 1, 2, 3)))
+
+        get = self.packer.prepare('GET')
+        self.assertEqual(
+            packed(get.pack('key')),
+            packed(self.connection.pack_command('GET', 'key')))
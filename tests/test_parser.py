@@ -0,0 +1,121 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from redis.exceptions import ConnectionError, InvalidResponse, ResponseError
+
+from redis_batch.parser import PythonReader, AsyncBufferedPythonParser
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+DATA = (b'+OK\r\n'
+        b':42\r\n'
+        b'$5\r\nhello\r\n'
+        b'$-1\r\n'
+        b'*-1\r\n'
+        b'*0\r\n'
+        b'*3\r\n$1\r\na\r\n*2\r\n:1\r\n*1\r\n$0\r\n\r\n:2\r\n'
+        b'-ERR wrong\r\n')
+
+REPLIES = [b'OK', 42, b'hello', None, None, [], [b'a', [1, [b'']], 2]]
+
+
+class TestPythonReader(unittest.TestCase):
+    def setUp(self):
+        self.reader = PythonReader()
+
+    def read_all(self):
+        replies = []
+        reply = self.reader.gets()
+        while reply is not False:
+            replies.append(reply)
+            reply = self.reader.gets()
+        return replies
+
+    def assertReplies(self, replies):
+        self.assertEqual(replies[:-1], REPLIES)
+        self.assertIsInstance(replies[-1], ResponseError)
+        self.assertEqual(replies[-1].args[0], 'ERR wrong')
+
+    def test_gets_all(self):
+        self.assertIs(self.reader.gets(), False)
+        self.reader.feed(DATA)
+        self.assertReplies(self.read_all())
+        self.assertEqual(len(self.reader._buffer), 0)
+
+    def test_byte_by_byte(self):
+        replies = []
+        for i in range(len(DATA)):
+            self.reader.feed(DATA[i:i + 1])
+            replies.extend(self.read_all())
+        self.assertReplies(replies)
+
+    def test_encoding(self):
+        reader = PythonReader(encoding='utf-8')
+        reader.feed(b'*2\r\n$2\r\n\xc3\xa9\r\n+OK\r\n')
+        self.assertEqual(reader.gets(), ['\xe9', 'OK'])
+
+    def test_protocol_error(self):
+        self.reader.feed(b'?\r\n')
+        self.assertRaises(InvalidResponse, self.reader.gets)
+
+    def test_large_bulk(self):
+        value = b'x' * 100000
+        data = b'$100000\r\n' + value + b'\r\n'
+        self.reader.feed(data[:50000])
+        self.assertIs(self.reader.gets(), False)
+        self.reader.feed(data[50000:])
+        self.assertEqual(self.reader.gets(), value)
+
+
+class TestAsyncReaderParser(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stream = asyncio.StreamReader(loop=self.loop)
+        self.stream.read = unittest.mock.Mock(wraps=self.stream.read)
+        connection = unittest.mock.Mock(decode_responses=False)
+        connection.get_reader.return_value = self.stream
+        self.parser = AsyncBufferedPythonParser()
+        self.parser.on_connect(connection)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_read_responses(self):
+        self.stream.feed_data(DATA)
+        on_reply = unittest.mock.Mock()
+        replies = self.loop.run_until_complete(
+            self.parser.read_responses(len(REPLIES) + 1, on_reply))
+        self.assertEqual(replies[:-1], REPLIES)
+        self.assertIsInstance(replies[-1], ResponseError)
+        self.assertEqual(on_reply.call_count, len(REPLIES) + 1)
+        on_reply.assert_any_call(2, b'hello')
+        self.assertEqual(self.stream.read.call_count, 1)
+
+    def test_read_size(self):
+        value = b'x' * 10000
+        self.stream.feed_data((b'$10000\r\n' + value + b'\r\n') * 100)
+        for i in range(20):
+            self.loop.run_until_complete(self.parser.read_responses(5))
+        self.assertGreater(self.parser.reply_size, 9000)
+        self.assertEqual(self.parser.read_size(500),
+                         self.parser.max_read_size)
+        self.assertEqual(self.parser.read_size(0),
+                         self.parser.min_read_size)
+
+    def test_cancelled(self):
+        read = asyncio.Task(self.parser.read_responses(1), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        read.cancel()
+        self.assertRaises(asyncio.CancelledError,
+                          self.loop.run_until_complete, read)
+        self.assertTrue(read.cancelled())
+
+    def test_closed(self):
+        self.stream.feed_data(b'+OK\r\n')
+        self.stream.feed_eof()
+        self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                          self.parser.read_responses(2))
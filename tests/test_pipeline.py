@@ -0,0 +1,559 @@
+import asyncio
+import unittest
+import unittest.mock
+import concurrent.futures
+import threading
+
+from redis.exceptions import ConnectionError, ResponseError
+
+from redis_batch.connection import AsyncConnection
+from redis_batch.parser import AsyncBufferedPythonParser
+
+from redis_batch.pipeline import AsyncStrictPipeline
+from redis_batch.retry import RetryPolicy
+from redis_batch.utils import PipeCommandQueue
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class PipelineTestBase(unittest.TestCase):
+    pipeline_kwargs = {}
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.threads = []
+
+        def callback(response, **options):
+            self.threads.append(threading.current_thread())
+            return len(response)
+
+        self.pipe = AsyncStrictPipeline(
+            unittest.mock.Mock(), unittest.mock.Mock(),
+            {'HGETALL': callback, 'LRANGE': callback},
+            transaction=False, shard_hint=None, loop=self.loop,
+            **self.pipeline_kwargs)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def resolve(self, *args, response):
+        fut = asyncio.Future(loop=self.loop)
+        self.pipe.resolve_future((fut, args, {}), response)
+        return self.loop.run_until_complete(fut)
+
+
+class ConnectionTestBase(PipelineTestBase):
+    """Pipeline executing on a connection reading replies fed to it"""
+    pipeline_kwargs = {'retry_policy': RetryPolicy(retries=0)}
+
+    def setUp(self):
+        super().setUp()
+        self.connection = AsyncConnection(
+            loop=self.loop, parser_class=AsyncBufferedPythonParser)
+        self.connection._reader = asyncio.StreamReader(loop=self.loop)
+        self.connection._writer = unittest.mock.Mock(
+            drain=asyncio.coroutine(unittest.mock.Mock()))
+        self.connection._parser.on_connect(self.connection)
+        self.pipe.connection_pool.acquire = asyncio.coroutine(
+            lambda: self.connection)
+
+    def feed(self, data):
+        self.connection._reader.feed_data(data)
+        self.loop.run_until_complete(asyncio.sleep(0.001, loop=self.loop))
+
+    def written(self):
+        return b''.join(call[0][0] for call in
+                        self.connection._writer.write.call_args_list)
+
+    def execute(self, mode, *commands):
+        """Start executing `commands`, returns (task, futures)"""
+        self.pipe.mode = mode
+        futures = [asyncio.Future(loop=self.loop) for args in commands]
+        task = asyncio.Task(self.pipe.execute_stack(
+            [(fut, args, {}) for fut, args in zip(futures, commands)],
+            raise_on_error=False), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.001, loop=self.loop))
+        return task, futures
+
+
+class TestExecutePipeline(ConnectionTestBase):
+    def test_resolved_as_replies_arrive(self):
+        task, futures = self.execute(
+            'pipeline', ('GET', 'a'), ('INCR', 'b'), ('GET', 'c'))
+        self.assertEqual(self.written(), b''.join([
+            b'*2\r\n$3\r\nGET\r\n$1\r\na\r\n',
+            b'*2\r\n$4\r\nINCR\r\n$1\r\nb\r\n',
+            b'*2\r\n$3\r\nGET\r\n$1\r\nc\r\n']))
+        self.feed(b'$1\r\nv\r\n:')
+        self.assertEqual(futures[0].result(), b'v')
+        self.assertFalse(futures[1].done())
+        self.feed(b'1\r\n$-1\r\n')
+        self.loop.run_until_complete(task)
+        self.assertEqual([fut.result() for fut in futures], [b'v', 1, None])
+
+    def test_error_reply(self):
+        task, futures = self.execute(
+            'pipeline', ('GET', 'a'), ('INCR', 'b'), ('GET', 'c'))
+        self.feed(b'$1\r\nv\r\n-ERR not an integer\r\n$1\r\nw\r\n')
+        self.loop.run_until_complete(task)
+        self.assertEqual(futures[0].result(), b'v')
+        self.assertIsInstance(futures[1].exception(), ResponseError)
+        self.assertIn('Command # 2 (INCR b)', str(futures[1].exception()))
+        self.assertEqual(futures[2].result(), b'w')
+        self.assertEqual(self.pipe.stats['error_replies'], 1)
+
+    def test_connection_lost(self):
+        task, futures = self.execute('pipeline', ('GET', 'a'), ('GET', 'b'))
+        self.feed(b'$1\r\nv\r\n')
+        self.connection._reader.feed_eof()
+        self.loop.run_until_complete(task)
+        self.assertEqual(futures[0].result(), b'v')
+        self.assertIsInstance(futures[1].exception(), ConnectionError)
+
+
+class TestExecuteTransaction(ConnectionTestBase):
+    def test_replies(self):
+        task, futures = self.execute(
+            'transaction', ('GET', 'a'), ('INCR', 'b'))
+        self.assertTrue(self.written().startswith(
+            b'*1\r\n$5\r\nMULTI\r\n'))
+        self.assertTrue(self.written().endswith(b'*1\r\n$4\r\nEXEC\r\n'))
+        self.feed(b'+OK\r\n+QUEUED\r\n+QUEUED\r\n')
+        self.assertFalse(futures[0].done())
+        self.feed(b'*2\r\n$1\r\nv\r\n:1\r\n')
+        self.loop.run_until_complete(task)
+        self.assertEqual([fut.result() for fut in futures], [b'v', 1])
+
+    def test_error_in_exec(self):
+        task, futures = self.execute(
+            'transaction', ('INCR', 'a'), ('GET', 'b'), ('INCR', 'c'))
+        self.feed(b'+OK\r\n+QUEUED\r\n+QUEUED\r\n+QUEUED\r\n'
+                  b'*3\r\n-ERR not an integer\r\n$1\r\nv\r\n:2\r\n')
+        self.loop.run_until_complete(task)
+        self.assertIn('Command # 1 (INCR a)', str(futures[0].exception()))
+        self.assertEqual(futures[1].result(), b'v')
+        self.assertEqual(futures[2].result(), 2)
+
+    def test_error_queuing(self):
+        task, futures = self.execute(
+            'transaction', ('GET', 'a'), ('INCR', 'b', 'c'))
+        self.feed(b'+OK\r\n+QUEUED\r\n-ERR wrong number of arguments\r\n'
+                  b'-EXECABORT Transaction discarded\r\n')
+        self.loop.run_until_complete(task)
+        for fut in futures:
+            self.assertIsInstance(fut.exception(), ResponseError)
+            self.assertIn('Command # 2 (INCR b c)', str(fut.exception()))
+
+
+class TestHealthCheck(ConnectionTestBase):
+    def test_ping(self):
+        self.connection.needs_health_check = True
+        task, futures = self.execute('pipeline', ('GET', 'a'))
+        self.assertFalse(self.connection.needs_health_check)
+        self.assertEqual(self.written(), b'*1\r\n$4\r\nPING\r\n'
+                                         b'*2\r\n$3\r\nGET\r\n$1\r\na\r\n')
+        self.feed(b'+PONG\r\n$1\r\nv\r\n')
+        self.loop.run_until_complete(task)
+        self.assertEqual(futures[0].result(), b'v')
+
+    def test_ping_before_multi(self):
+        self.connection.needs_health_check = True
+        task, futures = self.execute('transaction', ('GET', 'a'))
+        self.assertTrue(self.written().startswith(
+            b'*1\r\n$4\r\nPING\r\n*1\r\n$5\r\nMULTI\r\n'))
+        self.feed(b'+PONG\r\n+OK\r\n+QUEUED\r\n*1\r\n$1\r\nv\r\n')
+        self.loop.run_until_complete(task)
+        self.assertEqual(futures[0].result(), b'v')
+
+    def test_no_ping(self):
+        task, futures = self.execute('pipeline', ('GET', 'a'))
+        self.assertEqual(self.written(),
+                         b'*2\r\n$3\r\nGET\r\n$1\r\na\r\n')
+        self.feed(b'$1\r\nv\r\n')
+        self.loop.run_until_complete(task)
+
+    def test_bad_pong(self):
+        self.connection.needs_health_check = True
+        task, futures = self.execute('pipeline', ('GET', 'a'))
+        self.feed(b'$1\r\nv\r\n')
+        self.loop.run_until_complete(task)
+        self.assertIsInstance(futures[0].exception(), ConnectionError)
+        self.assertIsNone(self.connection._writer)  # disconnected
+
+
+class TestResolveFuture(PipelineTestBase):
+    def test_inline(self):
+        self.assertEqual(self.resolve('LRANGE', 'l', response=[1, 2]), 2)
+        self.assertEqual(self.resolve('GET', 'k', response=b'v'), b'v')
+        self.assertEqual(self.threads, [threading.current_thread()])
+
+    def test_callback_error(self):
+        self.pipe.response_callbacks = dict(
+            self.pipe.response_callbacks, HGETALL=lambda r: r[10])
+        commands = [(asyncio.Future(loop=self.loop), args, {}) for args in
+                    [('GET', 'k'), ('HGETALL', 'h'), ('LRANGE', 'l')]]
+        self.pipe.resolve_futures(commands, [b'v', [1], [1, 2]])
+        futures = [fut for fut, args, options in commands]
+        self.assertEqual(futures[0].result(), b'v')
+        self.assertIsInstance(futures[1].exception(), IndexError)
+        self.assertEqual(futures[2].result(), 2)
+        self.assertEqual(self.pipe.stats['callback_errors'], 1)
+
+
+class TestResolveFutureOffload(PipelineTestBase):
+    pipeline_kwargs = {
+        'offload_commands': ['HGETALL'],
+        'offload_threshold': 2,
+    }
+
+    def setUp(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.pipeline_kwargs = dict(self.pipeline_kwargs,
+                                    executor=self.executor)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    def test_offload_commands(self):
+        self.assertEqual(self.resolve('HGETALL', 'h', response=[1, 2]), 2)
+        self.assertNotEqual(self.threads, [threading.current_thread()])
+
+    def test_offload_threshold(self):
+        self.assertEqual(self.resolve('LRANGE', 'l', response=[1, 2]), 2)
+        self.assertEqual(self.resolve('LRANGE', 'l', response=[1, 2, 3]), 3)
+        self.assertEqual(self.threads[0], threading.current_thread())
+        self.assertNotEqual(self.threads[1], threading.current_thread())
+
+    def test_no_callback(self):
+        self.assertEqual(self.resolve('GET', 'k', response=b'value'),
+                         b'value')
+
+    def test_callback_error(self):
+        self.pipe.response_callbacks = {'HGETALL': lambda r: r[10]}
+        self.assertRaises(IndexError, self.resolve, 'HGETALL', 'h',
+                          response=[1])
+
+    def test_executor_cancelled(self):
+        executor_fut = asyncio.Future(loop=self.loop)
+        executor_fut.cancel()
+        fut = asyncio.Future(loop=self.loop)
+        with unittest.mock.patch.object(
+                self.loop, 'run_in_executor', return_value=executor_fut):
+            self.pipe.resolve_future((fut, ('HGETALL', 'h'), {}), [1])
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertTrue(fut.cancelled())
+
+
+class TestResolveBatch(PipelineTestBase):
+    pipeline_kwargs = {'resolve_slice': 4, 'max_loop_lag': 0.005}
+
+    def test_slices(self):
+        futures = [asyncio.Future(loop=self.loop) for i in range(10)]
+        commands = [(fut, ('GET', 'k'), {}) for fut in futures]
+        done = []
+
+        def tick():
+            done.append(sum(fut.done() for fut in futures))
+            if len(done) < 3:
+                self.loop.call_soon(tick)
+
+        self.loop.call_soon(tick)
+        self.loop.run_until_complete(
+            self.pipe.resolve_batch(commands, list(range(10))))
+        self.assertEqual([fut.result() for fut in futures], list(range(10)))
+        self.assertEqual(done, [0, 4, 8])
+
+    def test_adapt_slice(self):
+        self.pipe.adapt_slice(0.01)
+        self.assertEqual(self.pipe.slice_size, 2)
+        self.pipe.adapt_slice(0.01)
+        self.pipe.adapt_slice(0.01)
+        self.assertEqual(self.pipe.slice_size, 1)
+        self.pipe.adapt_slice(0.001)
+        self.assertEqual(self.pipe.slice_size, 2)
+        self.pipe.adapt_slice(0.001)
+        self.pipe.adapt_slice(0.001)
+        self.assertEqual(self.pipe.slice_size, 4)
+
+
+class TestBatchFailure(PipelineTestBase):
+    def setUp(self):
+        super().setUp()
+        self.pipe.connection_pool.acquire = asyncio.coroutine(
+            unittest.mock.Mock(side_effect=ConnectionError('refused')))
+
+    def execute_stack(self, n, raise_on_error):
+        futures = [asyncio.Future(loop=self.loop) for i in range(n)]
+        futures[0].cancel()
+        commands = [(fut, ('GET', 'k'), {}) for fut in futures]
+        self.loop.run_until_complete(
+            self.pipe.execute_stack(commands, raise_on_error))
+        return futures
+
+    def test_fail_futures(self):
+        futures = self.execute_stack(3, raise_on_error=False)
+        self.assertTrue(futures[0].cancelled())
+        for fut in futures[1:]:
+            self.assertIsInstance(fut.exception(), ConnectionError)
+        self.assertEqual(self.pipe.stats['failed_batches'], 1)
+        self.assertEqual(self.pipe.stats['failed_futures'], 2)
+        self.assertEqual(
+            self.pipe.stats['failed_futures.ConnectionError'], 2)
+        self.assertEqual(self.pipe.stats['pruned'], 1)
+
+    def test_raise_on_error(self):
+        self.assertRaises(ConnectionError, self.execute_stack, 3,
+                          raise_on_error=True)
+        self.assertEqual(self.pipe.stats['failed_futures'], 2)
+
+    def test_prune_done(self):
+        futures = self.execute_stack(1, raise_on_error=True)
+        self.assertTrue(futures[0].cancelled())
+        self.assertEqual(self.pipe.stats['pruned'], 1)
+        self.assertEqual(self.pipe.stats['failed_batches'], 0)
+
+
+class TestModes(PipelineTestBase):
+    def setUp(self):
+        super().setUp()
+        self.executed = []
+        self.pipe.connection_pool.acquire = asyncio.coroutine(
+            unittest.mock.Mock(return_value=unittest.mock.Mock()))
+
+        def execute(name):
+            @asyncio.coroutine
+            def execute(conn, commands, raise_on_error):
+                self.executed.append(
+                    (name, [args for f, args, options in commands]))
+            return execute
+
+        self.pipe._execute_transaction = execute('transaction')
+        self.pipe._execute_pipeline = execute('pipeline')
+
+    def execute_stack(self, mode, stack):
+        self.pipe.mode = mode
+        self.loop.run_until_complete(self.pipe.execute_stack(stack))
+        return self.executed.pop()
+
+    def command(self, *args, **options):
+        return (asyncio.Future(loop=self.loop), args, options)
+
+    def test_transaction(self):
+        stack = [self.command('GET', 'a')]
+        self.assertEqual(self.execute_stack('transaction', stack),
+                         ('transaction', [('GET', 'a')]))
+
+    def test_pipeline(self):
+        stack = [self.command('GET', 'a'),
+                 self.command('INCR', 'b', atomic=True)]
+        self.assertEqual(self.execute_stack('pipeline', stack)[0],
+                         'pipeline')
+
+    def test_auto(self):
+        stack = [self.command('GET', 'a'), self.command('INCR', 'b')]
+        self.assertEqual(self.execute_stack('auto', stack)[0], 'pipeline')
+        stack.append(self.command('INCR', 'c', atomic=True))
+        self.assertEqual(self.execute_stack('auto', stack)[0],
+                         'transaction')
+
+    def test_group(self):
+        self.pipe.command_stack = unittest.mock.Mock()
+        group = [(asyncio.Future(loop=self.loop), args)
+                 for args in [('INCR', 'h'), ('EXPIRE', 'h', 60)]]
+        self.pipe.push_group(asyncio.Future(loop=self.loop), group, {})
+        record = self.pipe.command_stack.push.call_args[0][0]
+        self.assertEqual(record[1], ('INCR', 'h'))
+
+        stack = [self.command('GET', 'a'), record]
+        self.assertEqual(self.execute_stack('auto', stack), (
+            'transaction', [('GET', 'a'), ('INCR', 'h'), ('EXPIRE', 'h', 60)]))
+
+    def test_group_one_batch(self):
+        queue = PipeCommandQueue(timeout=1, maxsize=2, loop=self.loop)
+        queue.pipe = self.pipe
+        self.pipe.command_stack = queue
+        self.pipe.mode = 'auto'
+        self.pipe.push_command(asyncio.Future(loop=self.loop), ('GET', 'a'),
+                               {})
+        group = [(asyncio.Future(loop=self.loop), args)
+                 for args in [('INCR', 'h'), ('EXPIRE', 'h', 60)]]
+        self.pipe.push_group(asyncio.Future(loop=self.loop), group, {})
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(self.executed, [
+            ('transaction', [('GET', 'a'), ('INCR', 'h'), ('EXPIRE', 'h', 60)])
+        ])
+
+
+class TestExecuteOn(PipelineTestBase):
+    def execute_on(self, disconnected_meanwhile):
+        conn = unittest.mock.Mock(generation=0)
+
+        @asyncio.coroutine
+        def execute(conn, stack, raise_on_error):
+            if disconnected_meanwhile:  # by an earlier batch failing
+                conn.generation += 1
+            raise ConnectionError('lost')
+
+        self.pipe._execute_pipeline = execute
+        self.assertRaises(
+            ConnectionError, self.loop.run_until_complete,
+            self.pipe._execute_on(conn, [], raise_on_error=True))
+        return conn.disconnect.call_count
+
+    def test_disconnect(self):
+        self.assertEqual(self.execute_on(disconnected_meanwhile=False), 1)
+
+    def test_disconnected_meanwhile(self):
+        self.assertEqual(self.execute_on(disconnected_meanwhile=True), 0)
+
+
+class TestSlots(PipelineTestBase):
+    pipeline_kwargs = {'max_inflight': 2, 'mode': 'transaction'}
+
+    def setUp(self):
+        super().setUp()
+        self.executed = []
+        pool = self.pipe.connection_pool
+        pool.acquire = asyncio.coroutine(unittest.mock.Mock(
+            side_effect=lambda: unittest.mock.Mock()))
+
+        @asyncio.coroutine
+        def execute_on(conn, commands, raise_on_error):
+            self.executed.append(
+                (conn, [args[1] for f, args, options in commands]))
+
+        self.pipe._execute_on = execute_on
+        # keys routed to different slots
+        keys = ['k%d' % i for i in range(10)]
+        self.keys = [keys[0]] + [
+            k for k in keys if self.pipe.route(('GET', k)) !=
+            self.pipe.route(('GET', keys[0]))][:1]
+
+    def execute_stack(self):
+        commands = [(asyncio.Future(loop=self.loop), ('GET', key), {})
+                    for key in self.keys]
+        self.loop.run_until_complete(self.pipe.execute_stack(commands))
+
+    def test_transaction_not_split(self):
+        self.execute_stack()
+        self.assertEqual([keys for conn, keys in self.executed], [self.keys])
+
+    def test_transactions_on_other_slots(self):
+        replies = {key: asyncio.Future(loop=self.loop) for key in self.keys}
+        started = []
+
+        @asyncio.coroutine
+        def execute_on(conn, commands, raise_on_error):
+            key = commands[0][1][1]
+            started.append(key)
+            return (yield from replies[key])
+
+        self.pipe._execute_on = execute_on
+        tasks = [asyncio.Task(self.pipe.execute_stack(
+            [(asyncio.Future(loop=self.loop), ('GET', key), {})]),
+            loop=self.loop) for key in self.keys + self.keys[:1]]
+        self.loop.run_until_complete(asyncio.sleep(0.001, loop=self.loop))
+        # the third one waits for the first one, on the same slot
+        self.assertEqual(started, self.keys)
+        for reply in replies.values():
+            reply.set_result([b'v'])
+        self.loop.run_until_complete(asyncio.gather(*tasks, loop=self.loop))
+        self.assertEqual(started, self.keys + self.keys[:1])
+
+    def test_multiplex_transaction(self):
+        self.assertRaises(
+            ValueError, AsyncStrictPipeline, unittest.mock.Mock(),
+            unittest.mock.Mock(), {}, transaction=False, shard_hint=None,
+            loop=self.loop, mode='auto', max_inflight=2, multiplex=True)
+
+    def test_pipeline_split(self):
+        self.pipe.mode = 'pipeline'
+        self.execute_stack()
+        self.assertEqual(sorted(keys for conn, keys in self.executed),
+                         sorted([key] for key in self.keys))
+
+    def test_release_slots(self):
+        self.pipe.mode = 'pipeline'
+        self.execute_stack()
+        self.pipe.release_slots()
+        released = [call[0][0] for call in
+                    self.pipe.connection_pool.release.call_args_list]
+        self.assertEqual(sorted(map(id, released)),
+                         sorted(id(conn) for conn, keys in self.executed))
+        self.assertEqual([slot.connection for slot in self.pipe.slots],
+                         [None, None])
+
+    def test_release_slots_in_flight(self):
+        reply = asyncio.Future(loop=self.loop)
+
+        @asyncio.coroutine
+        def execute_on(conn, commands, raise_on_error):
+            return (yield from reply)
+
+        self.pipe._execute_on = execute_on
+        self.pipe.mode = 'pipeline'
+        commands = [(asyncio.Future(loop=self.loop), ('GET', 'k'), {})]
+        task = asyncio.Task(self.pipe.execute_stack(commands),
+                            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        connection = self.pipe.slots[self.pipe.route(('GET', 'k'))].connection
+
+        self.pipe.release_slots()
+        release = self.pipe.connection_pool.release
+        self.assertEqual(release.call_count, 0)
+        reply.set_result([b'v'])
+        self.loop.run_until_complete(task)
+        release.assert_called_once_with(connection)
+
+
+class TestSlotConnectionFailure(PipelineTestBase):
+    pipeline_kwargs = {'max_inflight': 1, 'multiplex': True,
+                       'retry_policy': RetryPolicy(retries=0)}
+
+    def setUp(self):
+        super().setUp()
+        self.connections = []
+        self.replies = {}
+
+        def connection():
+            self.connections.append(unittest.mock.Mock())
+            return self.connections[-1]
+
+        pool = self.pipe.connection_pool
+        pool.acquire = asyncio.coroutine(
+            unittest.mock.Mock(side_effect=connection))
+
+        @asyncio.coroutine
+        def execute_on(conn, commands, raise_on_error):
+            return (yield from self.replies[commands[0][1][1]])
+
+        self.pipe._execute_on = execute_on
+
+    def execute(self, key):
+        self.replies[key] = asyncio.Future(loop=self.loop)
+        commands = [(asyncio.Future(loop=self.loop), ('GET', key), {})]
+        task = asyncio.Task(self.pipe.execute_stack(commands, False),
+                            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        return task
+
+    def test_first_batch_fails(self):
+        first, second = self.execute('a'), self.execute('b')
+        self.replies['a'].set_exception(ConnectionError('lost'))
+        self.loop.run_until_complete(first)
+        # the second batch still waits for its replies on the connection
+        release = self.pipe.connection_pool.release
+        self.assertEqual(release.call_count, 0)
+
+        third = self.execute('c')
+        self.assertEqual(len(self.connections), 2)
+        self.replies['b'].set_exception(ConnectionError('lost'))
+        self.replies['c'].set_result(['ok'])
+        self.loop.run_until_complete(asyncio.gather(second, third,
+                                                    loop=self.loop))
+        release.assert_called_once_with(self.connections[0])
+        self.assertIs(self.pipe.slots[0].connection, self.connections[1])
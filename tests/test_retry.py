@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from redis.exceptions import ConnectionError
+
+from redis_batch.connection import ConnectError
+from redis_batch.retry import RetryPolicy
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.policy = RetryPolicy(retries=2, backoff=0.1, max_backoff=0.3,
+                                  max_retry_rate=1, max_retry_burst=2)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def command(self, *args):
+        return (asyncio.Future(loop=self.loop), args, {})
+
+    def test_split(self):
+        get, incr, mget = (self.command('GET', 'a'), self.command('INCR', 'n'),
+                           self.command('mget', 'a', 'b'))
+        done = self.command('GET', 'b')
+        done[0].set_result(None)
+        commands = [get, incr, done, mget]
+
+        exc = ConnectionError()
+        self.assertEqual(self.policy.split(commands, exc),
+                         ([get, mget], [incr]))
+        self.assertEqual(self.policy.split(commands, exc, transaction=True),
+                         ([], [get, incr, mget]))
+        self.assertEqual(self.policy.split([get, mget], exc, True),
+                         ([get, mget], []))
+        self.assertEqual(self.policy.split(commands, ConnectError()),
+                         ([get, incr, mget], []))
+
+    def test_allow(self):
+        self.assertTrue(self.policy.allow(0, now=0))
+        self.assertFalse(self.policy.allow(2, now=0))  # out of retries
+        self.assertTrue(self.policy.allow(1, now=0))
+        self.assertFalse(self.policy.allow(0, now=0.5))  # out of budget
+        self.assertTrue(self.policy.allow(0, now=1.5))
+
+    def test_delay(self):
+        for attempt, cap in [(0, 0.1), (1, 0.2), (5, 0.3)]:
+            delay = self.policy.delay(attempt)
+            self.assertTrue(0 <= delay <= cap, (attempt, delay))
@@ -0,0 +1,122 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from redis.exceptions import ResponseError
+
+from redis_batch.parser import AsyncBufferedPythonParser
+from redis_batch.stream import ReplyStream
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class TestReplyStream(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.reader = asyncio.StreamReader(loop=self.loop)
+        self.connection = unittest.mock.Mock(
+            decode_responses=False, _parser=AsyncBufferedPythonParser())
+        self.connection.get_reader.return_value = self.reader
+        self.connection.with_timeout = lambda read: read
+        self.connection.send_packed_command = asyncio.coroutine(
+            lambda command: None)
+        self.pipe = unittest.mock.Mock(_loop=self.loop)
+        self.pipe.acquire_connection = asyncio.coroutine(
+            lambda: self.connection)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read_all(self, stream):
+        chunks = []
+        chunk = self.loop.run_until_complete(stream.next_chunk())
+        while chunk:
+            chunks.append(chunk)
+            chunk = self.loop.run_until_complete(stream.next_chunk())
+        return chunks
+
+    def test_chunks(self):
+        self.reader.feed_data(b'*5\r\n:1\r\n:2\r\n*2\r\n:3\r\n:4\r\n'
+                              b'$1\r\na\r\n$-1\r\n')
+        stream = ReplyStream(self.pipe, ('LRANGE', 'key', 0, -1), 2)
+        self.assertEqual(self.read_all(stream),
+                         [[1, 2], [[3, 4], b'a'], [None]])
+        self.pipe.connection_pool.release.assert_called_once_with(
+            self.connection)
+        self.assertFalse(self.connection.disconnect.called)
+
+    def test_partial_data(self):
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        self.reader.feed_data(b'*3\r\n:1\r\n:2\r\n:')
+        self.assertEqual(
+            self.loop.run_until_complete(stream.next_chunk()), [1, 2])
+        self.reader.feed_data(b'3\r\n')
+        self.assertEqual(self.read_all(stream), [[3]])
+
+    def test_nil(self):
+        self.reader.feed_data(b'*-1\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        self.assertEqual(self.read_all(stream), [])
+        self.assertTrue(self.pipe.connection_pool.release.called)
+
+    def test_error(self):
+        self.reader.feed_data(b'-WRONGTYPE Operation against a key\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        self.assertRaises(ResponseError, self.loop.run_until_complete,
+                          stream.next_chunk())
+        self.assertTrue(self.pipe.connection_pool.release.called)
+        self.assertFalse(self.connection.disconnect.called)
+
+    def test_close_unread(self):
+        self.reader.feed_data(b'*3\r\n:1\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        self.loop.run_until_complete(stream.next_chunk())
+        stream.close()
+        self.assertTrue(self.connection.disconnect.called)
+        self.assertTrue(self.pipe.connection_pool.release.called)
+
+    def test_early_exit(self):
+        self.reader.feed_data(b'*3\r\n:1\r\n:2\r\n')
+
+        @asyncio.coroutine
+        def first():
+            with ReplyStream(self.pipe, ('SMEMBERS', 'key'), 1) as stream:
+                return (yield from stream.__anext__())
+
+        self.assertEqual(self.loop.run_until_complete(first()), 1)
+        self.assertTrue(self.connection.disconnect.called)
+        self.pipe.connection_pool.release.assert_called_once_with(
+            self.connection)
+
+    def test_async_exit_read_whole(self):
+        self.reader.feed_data(b'*1\r\n:1\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        self.assertEqual(self.read_all(stream), [[1]])
+        self.loop.run_until_complete(stream.__aexit__(None, None, None))
+        self.assertFalse(self.connection.disconnect.called)
+        self.pipe.connection_pool.release.assert_called_once_with(
+            self.connection)
+
+    def test_cancelled(self):
+        self.reader.feed_data(b'*3\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'))
+        read = asyncio.Task(stream.next_chunk(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.001, loop=self.loop))
+        read.cancel()
+        self.assertRaises(asyncio.CancelledError,
+                          self.loop.run_until_complete, read)
+        self.assertTrue(read.cancelled())
+        self.assertTrue(self.connection.disconnect.called)
+        self.pipe.connection_pool.release.assert_called_once_with(
+            self.connection)
+
+    def test_timeout(self):
+        self.reader.feed_data(b'*3\r\n')
+        stream = ReplyStream(self.pipe, ('SMEMBERS', 'key'), timeout=0.01)
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete,
+                          stream.next_chunk())
+        self.assertTrue(self.connection.disconnect.called)
+        self.pipe.connection_pool.release.assert_called_once_with(
+            self.connection)
@@ -3,7 +3,14 @@ import unittest
 import unittest.mock
 from functools import partial
 
-from redis_batch.utils import SizeDrainQueue, TimeSizeDrainQueue
+from redis_batch.utils import (
+    DrainQueueBase,
+    SizeDrainQueue,
+    TimeSizeDrainQueue,
+    AdaptiveTimeSizeDrainQueue,
+    IdleDrainQueue,
+    PipeLaneQueue,
+)
 
 
 if __name__ == "__main__":
@@ -28,6 +35,49 @@ class QueueTestBase(unittest.TestCase):
         self.loop.close()
 
 
+class TestDrainQueueBase(QueueTestBase):
+    def setUp(self):
+        super().setUp()
+        self.q = DrainQueueBase(maxsize=2, loop=self.loop)
+
+    def test_put_nowait_full(self):
+        self.q.put_nowait(1)
+        self.q.put_nowait(2)
+        self.assertRaises(asyncio.QueueFull, self.q.put_nowait, 3)
+        self.assertEqual(self.q.qsize(), 2)
+
+    def test_put_waits_for_flush(self):
+        self.q.put_nowait(1)
+        self.q.put_nowait(2)
+        t = asyncio.Task(self.q.put(3), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertFalse(t.done())
+        self.assertEqual(self.q.qsize(), 2)
+
+        self.assertEqual(self.q._flush(), [1, 2])
+        self.loop.run_until_complete(self.wait_for(t, 0.01))
+        self.assertEqual(self.q._queue, [3])
+
+    def test_flush_swaps_list(self):
+        self.q.push(1)
+        queue = self.q._queue
+        self.assertIs(self.q._flush(), queue)
+        self.assertEqual(self.q._queue, [])
+        self.assertIsNot(self.q._queue, queue)
+
+    def test_flush_over_maxsize(self):
+        [self.q.push(v) for v in range(5)]
+        self.assertEqual(self.q._flush(), [0, 1])
+        self.assertEqual(self.q._flush(), [2, 3])
+        self.assertEqual(self.q._queue, [4])
+
+    def test_flush_unbounded(self):
+        q = DrainQueueBase(loop=self.loop)
+        [q.push(v) for v in range(5)]
+        self.assertEqual(q._flush(), [0, 1, 2, 3, 4])
+        self.assertTrue(q.empty())
+
+
 class TestSizeDrainQueue(QueueTestBase):
 
     @unittest.mock.patch.object(SizeDrainQueue, 'drain')
@@ -66,6 +116,23 @@ class TestSizeDrainQueue(QueueTestBase):
 
         self.loop.run_until_complete(test())
 
+    @unittest.mock.patch.object(SizeDrainQueue, 'drain')
+    def test_push_over_maxsize(self, drain_m):
+        q = SizeDrainQueue(maxsize=2, loop=self.loop)
+
+        @asyncio.coroutine
+        def test():
+            [q.push(v) for v in range(5)]
+            self.assertEqual(q.qsize(), 5)
+            yield from asyncio.sleep(0.001, loop=self.loop)
+            self.assertEqual(drain_m.call_args_list,
+                             [unittest.mock.call([0, 1]),
+                              unittest.mock.call([2, 3])])
+            self.assertEqual(q.qsize(), 1)
+            self.assertEqual(q.get_nowait(), 4)
+
+        self.loop.run_until_complete(test())
+
     def test_multi_drain(self):
         class SizeSlowSumDrainQueue(SizeDrainQueue):
             SLEEP_TIME = 0.01
@@ -129,5 +196,177 @@ class TestTimeSizeDrainQueue(QueueTestBase):
 
         self.loop.run_until_complete(test())
 
+    @unittest.mock.patch.object(TimeSizeDrainQueue, 'drain')
+    def test_single_timer(self, drain_m):
+        timeout = 0.01
+        q = TimeSizeDrainQueue(timeout=timeout, maxsize=2, loop=self.loop)
+
+        @asyncio.coroutine
+        def test():
+            q.push(10)
+            timer = q._timer
+            self.assertIsNotNone(timer)
+            q.push(20)  # size drain
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(drain_m.call_count, 1)
+            q.push(30)  # armed timer is reused
+            self.assertIs(q._timer, timer)
+            yield from asyncio.sleep(timeout * 2, loop=self.loop)
+            self.assertEqual(drain_m.call_count, 2)
+            self.assertEqual(drain_m.call_args, unittest.mock.call([30]))
+            self.assertIsNone(q._timer)
+            self.assertEqual(len(q.drain_tasks), 0)
+
+        self.loop.run_until_complete(test())
+
+    @unittest.mock.patch.object(TimeSizeDrainQueue, 'drain')
+    def test_timer_fired_early(self, drain_m):
+        q = TimeSizeDrainQueue(timeout=0.01, loop=self.loop)
+        q.push(10)
+        timer_when = q._timer_when
+        q._timer.cancel()
+        with unittest.mock.patch.object(
+                self.loop, 'time', return_value=timer_when - 0.001):
+            q._on_timer()
+        self.assertIsNone(q._timer)
+        self.assertEqual(len(q.drain_tasks), 1)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(drain_m.call_args, unittest.mock.call([10]))
+        self.assertEqual(len(q.drain_tasks), 0)
+
+
+class TestIdleDrainQueue(QueueTestBase):
+
+    @unittest.mock.patch.object(IdleDrainQueue, 'drain')
+    def test_drain_tick(self, drain_m):
+        q = IdleDrainQueue(maxsize=10, loop=self.loop)
+
+        @asyncio.coroutine
+        def producer(*items):
+            [q.push(item) for item in items]
 
-# @TODO: add TestDelayedTask
+        @asyncio.coroutine
+        def test():
+            # both producers run in the same loop iteration
+            yield from asyncio.gather(producer(10, 20), producer(30),
+                                      loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(drain_m.call_args_list,
+                             [unittest.mock.call([10, 20, 30])])
+            q.push(40)
+            self.assertEqual(drain_m.call_count, 1)
+            yield from asyncio.sleep(0, loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(drain_m.call_count, 2)
+            self.assertEqual(drain_m.call_args, unittest.mock.call([40]))
+            self.assertEqual(len(q.drain_tasks), 0)
+
+        self.loop.run_until_complete(test())
+
+    @unittest.mock.patch.object(IdleDrainQueue, 'drain')
+    def test_drain_full(self, drain_m):
+        q = IdleDrainQueue(maxsize=2, loop=self.loop)
+
+        @asyncio.coroutine
+        def test():
+            [q.push(v) for v in range(5)]
+            yield from asyncio.sleep(0.001, loop=self.loop)
+            self.assertEqual(
+                drain_m.call_args_list,
+                [unittest.mock.call([0, 1]), unittest.mock.call([2, 3]),
+                 unittest.mock.call([4])])
+            self.assertTrue(q.empty())
+
+        self.loop.run_until_complete(test())
+
+
+class TestAdaptiveTimeSizeDrainQueue(QueueTestBase):
+
+    def _get_queue(self, arrivals, period=1.0):
+        q = AdaptiveTimeSizeDrainQueue(
+            timeout=0.01, maxsize=500,
+            timeout_range=(0.001, 0.05), maxsize_range=(10, 5000),
+            loop=self.loop)
+        q._arrivals = arrivals
+        q._arrivals_since = self.loop.time() - period
+        return q
+
+    def test_light_load(self):
+        q = self._get_queue(arrivals=1)
+        q.drain_done([10], 0.001)
+        self.assertEqual(q.timeout, 0.001)
+        self.assertEqual(q.maxsize, 10)
+
+    def test_heavy_load(self):
+        q = self._get_queue(arrivals=100000)
+        q.drain_done([10] * 500, 0.02)
+        self.assertAlmostEqual(q.rtt, 0.02)
+        self.assertAlmostEqual(q.arrival_rate, 100000, delta=100)
+        self.assertAlmostEqual(q.maxsize, 4000, delta=10)
+        self.assertAlmostEqual(q.timeout, 0.02)
+
+    def test_bounds(self):
+        q = self._get_queue(arrivals=10 ** 7)
+        q.drain_done([10] * 500, 1)
+        self.assertEqual(q.maxsize, 5000)
+        self.assertEqual(q.timeout, 0.001)
+
+
+class TestPipeLaneQueue(QueueTestBase):
+    def setUp(self):
+        super().setUp()
+        self.drained = []
+
+        @asyncio.coroutine
+        def execute_stack(q, raise_on_error=True):
+            self.drained.append([args[0] for fut, args, options in q])
+
+        self.q = PipeLaneQueue(
+            {'immediate': (0, 0), 'default': (0.01, 0), 'bulk': (0.05, 0)},
+            'default', {'hgetall': 'bulk'}, loop=self.loop)
+        self.q.pipe = unittest.mock.Mock(execute_stack=execute_stack)
+
+    def command(self, *args, **options):
+        return (None, args, options)
+
+    def test_routing(self):
+        self.q.push(self.command('HGETALL', 'h'))
+        self.q.push(self.command('GET', 'k'))
+        self.q.push(self.command(b'GET', 'k', lane='immediate'))
+        self.q.push(self.command('hgetall', 'h', lane='default'))
+        self.assertEqual(
+            {name: lane.qsize() for name, lane in self.q.lanes.items()},
+            {'immediate': 1, 'default': 2, 'bulk': 1})
+        self.assertEqual(self.q.timeout, 0.01)
+
+    def test_lane_windows(self):
+        self.q.push(self.command('HGETALL', 'h'))
+        self.q.push(self.command('GET', 'k'))
+        self.q.push(self.command('PING', lane='immediate'))
+        self.loop.run_until_complete(asyncio.sleep(0.001, loop=self.loop))
+        self.assertEqual(self.drained, [['PING']])
+        self.loop.run_until_complete(asyncio.sleep(0.02, loop=self.loop))
+        self.assertEqual(self.drained, [['PING'], ['GET']])
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(self.drained, [['PING'], ['GET'], ['HGETALL']])
+        self.assertTrue(self.q.empty())
+
+    def test_deadline_order(self):
+        self.q.push(self.command('HGETALL', 'h'))
+        self.q.push(self.command('GET', 'k'))
+        now = self.loop.time()
+        self.q.lanes['bulk'].timestamp = now - 1
+        self.q.lanes['default'].timestamp = now - 2
+        self.q._on_timer()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(self.drained, [['GET'], ['HGETALL']])
+
+    def test_timer_fired_early(self):
+        self.q.push(self.command('GET', 'k'))
+        self.q._timer.cancel()
+        with unittest.mock.patch.object(
+                self.loop, 'time', return_value=self.q._timer_when - 0.001):
+            self.q._on_timer()
+        self.assertIsNone(self.q._timer)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(self.drained, [['GET']])